@@ -0,0 +1,162 @@
+import os
+import json
+import secrets
+import logging
+from typing import Any, Dict, List, Optional
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import Depends, FastAPI, HTTPException, Security
+from fastapi.security import APIKeyHeader
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from batch import BATCH_CONCURRENCY, arun_batch
+from engine import CHAT_HISTORY_RETENTION, STATE_DEFAULTS, aprepare_query, astream_answer, init_state, record_answer
+from patients import get_roster
+
+load_dotenv()
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8000"))
+API_WORKERS = int(os.getenv("API_WORKERS", "4"))
+# Largest patient list one /batch request may ask about
+API_BATCH_MAX_PATIENTS = int(os.getenv("API_BATCH_MAX_PATIENTS", "1000"))
+# Comma-separated keys accepted in the X-API-Key header; with none set every
+# request except /health is refused
+API_KEYS = [k.strip() for k in os.getenv("API_KEYS", "").split(",") if k.strip()]
+BATCH_ERRORS = ("no chunks found", "patient not found")
+
+logger = logging.getLogger(__name__)
+app = FastAPI(title="EHR Query Agent API")
+api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
+
+
+def require_api_key(key: Optional[str] = Security(api_key_header)) -> None:
+    if not API_KEYS:
+        raise HTTPException(status_code=503, detail="API_KEYS is not configured")
+    if not key or not any(secrets.compare_digest(key, k) for k in API_KEYS):
+        raise HTTPException(status_code=401, detail="Invalid or missing API key",
+                            headers={"WWW-Authenticate": "X-API-Key"})
+
+
+class QueryRequest(BaseModel):
+    prompt: str
+    # Conversation state returned by the previous "done" event; the API keeps
+    # no sessions itself, so any worker process can serve any request
+    state: Optional[Dict[str, Any]] = None
+
+
+class BatchRequest(BaseModel):
+    question: str
+    patient_ids: List[str] = Field(..., min_length=1, max_length=API_BATCH_MAX_PATIENTS)
+    k: int = Field(6, ge=1, le=20)
+    concurrency: int = Field(BATCH_CONCURRENCY, ge=1)
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def _validated_state(state: Dict[str, Any], roster: List[Dict[str, str]]) -> Dict[str, Any]:
+    """
+    Replaces client-supplied patients in the state with their roster entries
+    and drops any that are not on the roster, so a caller cannot lock onto
+    arbitrary records by editing `state`. History keeps only well-formed
+    user/assistant messages, so no system prompt can be injected.
+    """
+    by_id = {p["patient_id"]: p for p in roster}
+
+    def known(patient: Any) -> Optional[Dict[str, str]]:
+        return by_id.get(patient.get("patient_id")) if isinstance(patient, dict) else None
+
+    def known_list(patients: Any) -> List[Dict[str, str]]:
+        return [p for p in map(known, patients) if p] if isinstance(patients, list) else []
+
+    state["locked_patient"] = known(state["locked_patient"])
+    state["active_patients"] = known_list(state["active_patients"])
+    state["awaiting_disambiguation"] = known_list(state["awaiting_disambiguation"]) or None
+    messages = state["messages"] if isinstance(state["messages"], list) else []
+    messages = [{"role": m["role"], "content": m["content"]} for m in messages
+                if isinstance(m, dict) and m.get("role") in ("user", "assistant")
+                and isinstance(m.get("content"), str)]
+    if CHAT_HISTORY_RETENTION > 0:
+        messages = messages[-CHAT_HISTORY_RETENTION:]
+    state["messages"] = messages
+    return state
+
+
+def _analysis_summary(analysis: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if not analysis:
+        return None
+    return {
+        "intent": analysis.get("intent"),
+        "confidence": analysis.get("confidence"),
+        "resolved_patient": analysis.get("resolved_patient"),
+        "resolved_patients": analysis.get("resolved_patients", []),
+        "candidates": analysis.get("candidates", []),
+    }
+
+
+@app.get("/health")
+async def health() -> Dict[str, str]:
+    return {"status": "ok"}
+
+
+@app.post("/query", dependencies=[Depends(require_api_key)])
+async def query(req: QueryRequest) -> StreamingResponse:
+    """
+    Answers one prompt as a server-sent event stream:
+      meta  - {analysis, sources} once routing and retrieval are done
+      token - {text} answer deltas
+      done  - {answer, state}; send `state` back with the next prompt
+      error - {detail} if the pipeline fails (details are logged server-side)
+    """
+    state = init_state({k: v for k, v in (req.state or {}).items() if k in STATE_DEFAULTS})
+
+    async def events():
+        try:
+            roster = await run_in_threadpool(get_roster)
+            _validated_state(state, roster)
+            prepared = await aprepare_query(req.prompt, roster, state)
+            yield _sse("meta", {"analysis": _analysis_summary(prepared["analysis"]),
+                                "sources": prepared["sources"]})
+            if prepared["reply"] is not None:
+                answer = prepared["reply"]
+                yield _sse("token", {"text": answer})
+            else:
+                parts: List[str] = []
+                async for text in astream_answer(prepared["messages"]):
+                    parts.append(text)
+                    yield _sse("token", {"text": text})
+                answer = "".join(parts)
+                record_answer(state, answer)
+            yield _sse("done", {"answer": answer, "state": dict(state)})
+        except Exception:
+            logger.exception("query failed")
+            yield _sse("error", {"detail": "internal error while answering the query"})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.post("/batch", dependencies=[Depends(require_api_key)])
+async def batch(req: BatchRequest) -> StreamingResponse:
+    """
+    Answers one question for every patient in `patient_ids` as JSON lines,
+    one {patient_id, name, question, answer, sources, error} per patient in
+    completion order.
+    """
+    concurrency = max(1, min(req.concurrency, BATCH_CONCURRENCY))
+
+    async def lines():
+        roster = await run_in_threadpool(get_roster)
+        async for item in arun_batch(req.question, req.patient_ids, roster, req.k, concurrency):
+            if item["error"] and item["error"] not in BATCH_ERRORS:
+                logger.error("batch answer for %s failed: %s", item["patient_id"], item["error"])
+                item["error"] = "internal error while answering"
+            yield json.dumps(item, default=str) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+if __name__ == "__main__":
+    uvicorn.run("api:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+from typing import Any, AsyncIterator, Dict, List, Optional
+from dotenv import load_dotenv
+from engine import LLM_MODEL, build_messages
+from llm_clients import acall_with_backoff, get_chat_model
+from orchestrator import run
+from patients import abuild_roster, get_roster
+from retrieve_supabase import amatch_patient_chunks_batch
+
+load_dotenv()
+# Concurrent LLM calls per batch (retrieval is bounded by RETRIEVAL_WORKERS)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Patients retrieved per batched RPC round; generation of one round overlaps
+# retrieval of the next
+BATCH_RETRIEVAL_GROUP = int(os.getenv("BATCH_RETRIEVAL_GROUP", "50"))
+
+
+def _result(patient_id: str, question: str, patient: Optional[Dict[str, str]] = None,
+            answer: Optional[str] = None, sources: Optional[List[Dict[str, Any]]] = None,
+            error: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "patient_id": patient_id,
+        "name": f"{patient['first_name']} {patient['last_name']}".strip() if patient else None,
+        "question": question,
+        "answer": answer,
+        "sources": sources or [],
+        "error": error,
+    }
+
+
+async def arun_batch(question: str,
+                     patient_ids: List[str],
+                     roster: List[Dict[str, str]],
+                     k: int = 6,
+                     concurrency: int = BATCH_CONCURRENCY) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Answers one question for many patients. The question is embedded once,
+    retrieval runs as grouped batch RPCs, and at most `concurrency` answers
+    are generated at a time with backoff on rate limits. Yields one result
+    dict per patient as soon as it is ready (not in input order).
+    """
+    by_id = {p["patient_id"]: p for p in roster}
+    # acall_with_backoff does the retrying
+    chat = get_chat_model(LLM_MODEL, max_retries=0)
+    limit = asyncio.Semaphore(max(1, concurrency))
+    results: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    tasks: List[asyncio.Task] = []
+
+    async def answer(patient: Dict[str, str], hits: List[Dict[str, Any]]) -> None:
+        pid = patient["patient_id"]
+        sources = [h["metadata"] for h in hits]
+        if not hits:
+            await results.put(_result(pid, question, patient, error="no chunks found"))
+            return
+        system = f"You are a clinical assistant. Use ONLY the retrieved patient context for {patient['first_name']} {patient['last_name']}."
+        messages = build_messages({"messages": []}, question, system,
+                                  {patient["patient_id"]: [h["content"] for h in hits]})
+        try:
+            async with limit:
+                reply = await acall_with_backoff(lambda: chat.ainvoke(messages))
+            await results.put(_result(pid, question, patient, reply.content, sources))
+        except Exception as e:
+            await results.put(_result(pid, question, patient, sources=sources, error=str(e)))
+
+    async def produce() -> None:
+        known: List[Dict[str, str]] = []
+        for pid in dict.fromkeys(patient_ids):
+            if pid in by_id:
+                known.append(by_id[pid])
+            else:
+                await results.put(_result(pid, question, error="patient not found"))
+        for i in range(0, len(known), BATCH_RETRIEVAL_GROUP):
+            group = known[i:i + BATCH_RETRIEVAL_GROUP]
+            try:
+                hits = await amatch_patient_chunks_batch(
+                    [(question, p["patient_id"], k) for p in group])
+            except Exception as e:
+                for p in group:
+                    await results.put(_result(p["patient_id"], question, p, error=str(e)))
+                continue
+            tasks.extend(asyncio.ensure_future(answer(p, hits[p["patient_id"]][0]))
+                         for p in group)
+        await asyncio.gather(*tasks)
+
+    producer = asyncio.ensure_future(produce())
+    producer.add_done_callback(lambda _: results.put_nowait(None))
+    try:
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            yield item
+        await producer  # re-raise anything unexpected
+    finally:
+        # Consumer gone (e.g. client disconnected): stop spending tokens
+        producer.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def arun_batch_to_jsonl(question: str, patient_ids: List[str], out,
+                              roster: Optional[List[Dict[str, str]]] = None,
+                              k: int = 6, concurrency: int = BATCH_CONCURRENCY) -> int:
+    """Writes one JSON line per patient to `out` as results arrive; returns the count."""
+    if roster is None:
+        roster = await abuild_roster()
+    count = 0
+    async for item in arun_batch(question, patient_ids, roster, k, concurrency):
+        out.write(json.dumps(item, default=str) + "\n")
+        out.flush()
+        count += 1
+    return count
+
+
+def _read_ids(path: str) -> List[str]:
+    with (sys.stdin if path == "-" else open(path)) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Ask one question about many patients.")
+    parser.add_argument("question")
+    parser.add_argument("--patients", default="", help="comma-separated patient IDs")
+    parser.add_argument("--patients-file", help="file with one patient ID per line ('-' for stdin)")
+    parser.add_argument("--out", default="-", help="JSONL output path ('-' for stdout)")
+    parser.add_argument("--k", type=int, default=6, help="chunks per patient")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    args = parser.parse_args()
+
+    patient_ids = [p.strip() for p in args.patients.split(",") if p.strip()]
+    if args.patients_file:
+        patient_ids += _read_ids(args.patients_file)
+    if not patient_ids:
+        parser.error("no patient IDs given")
+
+    roster = get_roster()
+    out = sys.stdout if args.out == "-" else open(args.out, "w")
+    try:
+        count = run(arun_batch_to_jsonl(args.question, patient_ids, out, roster,
+                                        args.k, args.concurrency))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Wrote {count} results", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
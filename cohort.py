@@ -0,0 +1,199 @@
+import os
+import re
+import operator
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from patient_facts import QUERY_ATTRIBUTES, requested_attributes
+from supabase_client import get_async_supabase
+
+load_dotenv()
+# Answer roster-wide aggregate questions from patient_facts (sql/patient_facts.sql)
+COHORT_QUERIES = os.getenv("COHORT_QUERIES", "1") not in ("0", "false", "False")
+COHORT_PAGE_SIZE = 1000
+
+# Only explicit roster-wide phrasing; anything else ("what does a low AMH
+# mean?") is left to the router
+ROSTER = r"(?:all (?:of )?)?(?:our|my|the|these|all) (?:patients|roster|cohort|clinic)"
+AGGREGATE = r"\b(?:average|mean|median|distribution|percent(?:age)?|proportion|share|number|count)\b"
+COHORT_PATTERN = re.compile(
+    r"\bhow many\b.{0,40}?\b(?:patients|women|couples)\b"
+    rf"|{AGGREGATE}.{{0,60}}?\b(?:across|of|among|for|in|over) {ROSTER}\b"
+    rf"|{AGGREGATE}.{{0,60}}?\b(?:by age|age bands?|age groups?)\b"
+    rf"|\bacross (?:all )?(?:of )?(?:our |my |the )?(?:patients|roster|cohort)\b"
+    r"|\b(?:whole|entire) (?:roster|cohort|clinic)\b|\ball (?:of )?(?:our|my|the) patients\b", re.I)
+BY_AGE_PATTERN = re.compile(r"\bby age\b|\bage bands?\b|\bage groups?\b", re.I)
+# "on Letrozole", "taking folic acid": the word after the verb names a drug
+MEDICATION_FILTER_PATTERN = re.compile(r"\b(?:on|taking|prescribed|using)\s+([a-z][a-z0-9-]*)", re.I)
+NOT_DRUG_WORDS = {
+    "a", "an", "the", "our", "my", "their", "any", "average", "day", "days", "cycle", "treatment",
+    "record", "file", "medication", "medications", "meds", "drugs", "it", "them", "each", "both",
+}
+
+# Prompt word -> wide-table column
+FILTER_COLUMNS = {
+    "amh": "amh", "fsh": "fsh", "e2": "e2", "estradiol": "e2", "oestradiol": "e2",
+    "bmi": "bmi", "weight": "weight", "height": "height", "temperature": "temperature",
+    "temp": "temperature", "systolic": "bp_systolic", "diastolic": "bp_diastolic", "age": "age",
+}
+OPERATORS = {
+    "<": "<", "<=": "<=", ">": ">", ">=": ">=", "=": "==",
+    "under": "<", "below": "<", "less than": "<", "lower than": "<",
+    "over": ">", "above": ">", "greater than": ">", "more than": ">", "higher than": ">",
+}
+COMPARE = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "==": operator.eq}
+FILTER_PATTERN = re.compile(
+    rf"\b({'|'.join(FILTER_COLUMNS)})\b(?:\s+(?:is|of|was|level))?\s*"
+    rf"({'|'.join(sorted(map(re.escape, OPERATORS), key=len, reverse=True))})\s*(\d+(?:\.\d+)?)",
+    re.I)
+# SART-style maternal age bands used in IVF reporting
+AGE_BANDS = [0, 35, 38, 41, 43, 200]
+AGE_LABELS = ["<35", "35-37", "38-40", "41-42", ">42"]
+
+
+def is_cohort_query(prompt: str) -> bool:
+    return bool(COHORT_PATTERN.search(prompt))
+
+
+def parse_medications(prompt: str) -> List[str]:
+    """Drug names the prompt filters on ("patients on Metformin" -> ["metformin"])."""
+    names = []
+    for word in MEDICATION_FILTER_PATTERN.findall(prompt):
+        word = word.lower()
+        if word not in NOT_DRUG_WORDS and word not in FILTER_COLUMNS and word not in names:
+            names.append(word)
+    return names
+
+
+def parse_filters(prompt: str) -> List[Tuple[str, str, float]]:
+    """Numeric filters such as "AMH < 1.0" or "BMI over 30" as (column, op, value)."""
+    return [(FILTER_COLUMNS[word.lower()], OPERATORS[op.lower()], float(value))
+            for word, op, value in FILTER_PATTERN.findall(prompt)]
+
+
+async def afetch_cohort_facts(attributes: List[str]) -> pd.DataFrame:
+    """Latest value per patient and attribute across the whole roster, one paged RPC."""
+    sb = await get_async_supabase()
+    rows: List[Dict[str, Any]] = []
+    start = 0
+    while True:
+        res = await sb.rpc("cohort_facts", {"p_attributes": attributes}).range(
+            start, start + COHORT_PAGE_SIZE - 1).execute()
+        page = res.data or []
+        rows.extend(page)
+        if len(page) < COHORT_PAGE_SIZE:
+            break
+        start += COHORT_PAGE_SIZE
+    return pd.DataFrame(rows, columns=["patient_id", "attribute", "value_num",
+                                       "value_text", "unit", "observed_on"])
+
+
+def cohort_frame(facts: pd.DataFrame, roster: List[Dict[str, str]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Wide table with one row per roster patient: numeric attributes (latest
+    value), age and age band. Also returns the long (patient_id, medication)
+    table.
+    """
+    wide = pd.DataFrame(roster, columns=["patient_id", "dob"]).drop_duplicates("patient_id")
+    wide = wide.set_index("patient_id")
+    dob = pd.to_datetime(wide["dob"], errors="coerce")
+    today = pd.Timestamp(date.today())
+    wide["age"] = np.floor((today - dob).dt.days / 365.25)
+    wide["age_band"] = pd.cut(wide["age"], AGE_BANDS, right=False, labels=AGE_LABELS)
+
+    numeric = facts[facts["attribute"] != "medication"]
+    if not numeric.empty:
+        values = numeric.pivot_table(index="patient_id", columns="attribute",
+                                     values="value_num", aggfunc="first")
+        wide = wide.join(values, how="left")
+
+    meds = facts.loc[facts["attribute"] == "medication", ["patient_id", "value_text"]]
+    meds = meds.assign(medication=meds["value_text"].str.lower()).drop(columns="value_text")
+    return wide.drop(columns="dob"), meds
+
+
+def _units(facts: pd.DataFrame) -> Dict[str, str]:
+    numeric = facts[facts["attribute"] != "medication"].dropna(subset=["unit"])
+    return numeric.groupby("attribute")["unit"].first().to_dict()
+
+
+def summarize_cohort(prompt: str, facts: pd.DataFrame,
+                     roster: List[Dict[str, str]], attributes: List[str]) -> List[str]:
+    """Aggregates the cohort the prompt describes; returns short text sections for the LLM."""
+    wide, meds = cohort_frame(facts, roster)
+    units = _units(facts)
+    total = len(wide)
+
+    mask = pd.Series(True, index=wide.index)
+    applied = []
+    for column, op, value in parse_filters(prompt):
+        if column not in wide:
+            continue
+        mask &= COMPARE[op](wide[column], value)  # missing values never match
+        applied.append(f"{column} {op} {value:g}{' ' + units[column] if column in units else ''}")
+    stored = set(meds["medication"].unique())
+    for drug in parse_medications(prompt):
+        # "folic" also matches "folic acid"; a drug nobody has matches nobody
+        names = {m for m in stored if m == drug or m.startswith(drug + " ")}
+        mask &= wide.index.isin(meds.loc[meds["medication"].isin(names), "patient_id"])
+        applied.append(f"on {' or '.join(sorted(names))}" if names else f"on {drug} (not recorded for any patient)")
+    cohort = wide[mask]
+
+    sections = [
+        "COHORT RESULT (computed over the structured records of every patient in the roster)\n"
+        f"Filters: {'; '.join(applied) if applied else 'none'}\n"
+        f"Matching patients: {len(cohort)} of {total}"
+        + (f" ({100 * len(cohort) / total:.1f}%)" if total else "")
+    ]
+    missing = [a for a in attributes if a != "medication" and a not in wide]
+    if missing:
+        sections[0] += f"\nNo structured values recorded for: {', '.join(missing)}"
+
+    columns = [a for a in attributes if a != "medication" and a in cohort]
+    if "age" in {c for c, _, _ in parse_filters(prompt)} or BY_AGE_PATTERN.search(prompt):
+        columns.append("age")
+    if columns:
+        stats = cohort[columns].agg(["count", "mean", "median", "min", "max"]).T
+        stats.index = [f"{c} ({units[c]})" if c in units else c for c in stats.index]
+        sections.append("Latest value per patient, over matching patients "
+                        "(count = patients with a recorded value):\n"
+                        + stats.round(2).to_string())
+
+    if BY_AGE_PATTERN.search(prompt):
+        grouped = cohort.groupby("age_band", observed=False)
+        bands = pd.DataFrame({"patients": grouped.size()})
+        for c in columns:
+            if c != "age":
+                bands[f"mean {c}"] = grouped[c].mean()
+        sections.append("By age band:\n" + bands.round(2).to_string())
+
+    if "medication" in attributes and not meds.empty:
+        in_cohort = meds[meds["patient_id"].isin(cohort.index)]
+        counts = in_cohort.groupby("medication")["patient_id"].nunique().sort_values(ascending=False)
+        sections.append("Patients per medication (top 15):\n" + counts.head(15).to_string())
+    return sections
+
+
+async def acohort_context(prompt: str,
+                          roster: List[Dict[str, str]]) -> Optional[Tuple[List[str], Dict[str, Any]]]:
+    """
+    Cohort statistics for a roster-wide question, or None if it names no
+    structured attribute. Returns (sections, source).
+    """
+    requested = requested_attributes(prompt)
+    # Filter words ("AMH < 1", "on Letrozole") also pull in their attribute
+    for column, _, _ in parse_filters(prompt):
+        for label, (_, attrs) in QUERY_ATTRIBUTES.items():
+            if column in attrs:
+                requested.setdefault(label, attrs)
+    if parse_medications(prompt):
+        requested.setdefault("medications", ("medication",))
+    attributes = [a for attrs in requested.values() for a in attrs]
+    if not attributes and not BY_AGE_PATTERN.search(prompt):
+        return None
+    facts = await afetch_cohort_facts(attributes)
+    sections = summarize_cohort(prompt, facts, roster, attributes)
+    return sections, {"source": "cohort_facts", "attributes": attributes,
+                      "patients": len(roster)}
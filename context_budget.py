@@ -0,0 +1,105 @@
+import os
+import threading
+from typing import Dict, List
+from dotenv import load_dotenv
+
+load_dotenv()
+# Prompt budget per LLM call: system + history + context + question
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
+# Most of the budget that conversation history may take
+CONTEXT_HISTORY_TOKENS = int(os.getenv("CONTEXT_HISTORY_TOKENS", "2000"))
+# Longer chunks are truncated to this many tokens
+CONTEXT_CHUNK_TOKENS = int(os.getenv("CONTEXT_CHUNK_TOKENS", "800"))
+# Per-message overhead of the chat format
+MESSAGE_OVERHEAD = 4
+# Don't bother adding a truncated chunk shorter than this
+MIN_CHUNK_TOKENS = 32
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoders: Dict[str, object] = {}
+_lock = threading.Lock()
+
+
+def _encoder(model: str):
+    """tiktoken encoding for `model`, or None if unavailable (then ~4 chars per token)."""
+    if model not in _encoders:
+        with _lock:
+            if model not in _encoders:
+                enc = None
+                if tiktoken is not None:
+                    try:
+                        try:
+                            enc = tiktoken.encoding_for_model(model)
+                        except KeyError:
+                            # Unknown model name: use the current default encoding
+                            enc = tiktoken.get_encoding("o200k_base")
+                    except Exception:
+                        # Encoding files could not be downloaded (offline)
+                        enc = None
+                _encoders[model] = enc
+    return _encoders[model]
+
+
+def count_tokens(text: str, model: str) -> int:
+    enc = _encoder(model)
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> str:
+    if max_tokens <= 0:
+        return ""
+    enc = _encoder(model)
+    if enc is None:
+        return text if len(text) <= max_tokens * 4 else text[:max_tokens * 4] + " …"
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens]) + " …"
+
+
+def fit_history(history: List[Dict[str, str]], budget: int, model: str) -> List[Dict[str, str]]:
+    """Newest messages from `history` that fit in `budget` tokens, oldest first."""
+    kept: List[Dict[str, str]] = []
+    for msg in reversed(history):
+        cost = count_tokens(msg["content"], model) + MESSAGE_OVERHEAD
+        if cost > budget:
+            break
+        kept.append(msg)
+        budget -= cost
+    return kept[::-1]
+
+
+def allocate_chunks(groups: Dict[str, List[str]], budget: int, model: str,
+                    separator_tokens: int = 2) -> Dict[str, List[str]]:
+    """
+    Fits ranked chunks from several groups (one per patient) into `budget`
+    tokens. The group that has used the fewest tokens so far adds its next
+    chunk, so patients get equal token shares and a patient with little data
+    leaves its share to the others. Chunks over CONTEXT_CHUNK_TOKENS, or the
+    last one that only partly fits, are truncated.
+    """
+    picked: Dict[str, List[str]] = {name: [] for name in groups}
+    used = {name: 0 for name, chunks in groups.items() if chunks}
+    pending = {name: list(chunks) for name, chunks in groups.items() if chunks}
+    while pending:
+        room = min(budget - separator_tokens, CONTEXT_CHUNK_TOKENS)
+        if room < MIN_CHUNK_TOKENS:
+            break
+        name = min(pending, key=used.__getitem__)
+        chunk = pending[name].pop(0)
+        if not pending[name]:
+            del pending[name]
+        cost = count_tokens(chunk, model)
+        if cost > room:
+            chunk = truncate_tokens(chunk, room, model)
+            cost = count_tokens(chunk, model)
+        picked[name].append(chunk)
+        used[name] += cost + separator_tokens
+        budget -= cost + separator_tokens
+    return picked
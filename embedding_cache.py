@@ -0,0 +1,165 @@
+import os
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed by sha256(model, text): a bounded in-memory
+    LRU in front of a SQLite store of float32 vectors. Thread-safe; the SQLite
+    file is shared by every session and process on the host.
+    """
+
+    def __init__(self, path: Optional[str] = CACHE_PATH, max_items: int = CACHE_SIZE):
+        self.path = path
+        self.max_items = max_items
+        self._mem: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            try:
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, model TEXT NOT NULL, vec BLOB NOT NULL)")
+                self._db.commit()
+            except (sqlite3.Error, OSError):
+                # Read-only or missing filesystem: fall back to memory only
+                self._db = None
+
+    def _disable(self, error: Exception) -> None:
+        # Locked, full or corrupt store at runtime: keep serving from memory
+        logger.warning("embedding cache %s disabled, using memory only: %s", self.path, error)
+        try:
+            self._db.close()
+        except sqlite3.Error:
+            pass
+        self._db = None
+
+    def _remember(self, key: str, vec: List[float]) -> None:
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[str, List[float]]:
+        """Returns {text: vector} for every text already cached."""
+        found: Dict[str, List[float]] = {}
+        missing: Dict[str, str] = {}
+        with self._lock:
+            for text in texts:
+                key = cache_key(model, text)
+                if key in self._mem:
+                    self._mem.move_to_end(key)
+                    found[text] = self._mem[key]
+                else:
+                    missing[key] = text
+            if missing and self._db is not None:
+                keys = list(missing)
+                try:
+                    for i in range(0, len(keys), 500):
+                        part = keys[i:i + 500]
+                        rows = self._db.execute(
+                            f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})",
+                            part).fetchall()
+                        for key, blob in rows:
+                            vec = array("f", blob).tolist()
+                            self._remember(key, vec)
+                            found[missing[key]] = vec
+                except sqlite3.Error as e:
+                    self._disable(e)
+        return found
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        with self._lock:
+            rows = []
+            for text, vec in vectors.items():
+                key = cache_key(model, text)
+                self._remember(key, list(vec))
+                rows.append((key, model, array("f", vec).tobytes()))
+            if rows and self._db is not None:
+                try:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, model, vec) VALUES (?, ?, ?)",
+                        rows)
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    self._disable(e)
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        return self.get_many(model, [text]).get(text)
+
+
+class CachedEmbeddings:
+    """
+    Drop-in wrapper around a LangChain embeddings object that only calls the
+    embeddings API for texts not already in the cache.
+    """
+
+    def __init__(self, embeddings, model: str, cache: Optional[EmbeddingCache] = None):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache or get_embedding_cache()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        found = self.cache.get_many(self.model, texts)
+        todo = [t for t in dict.fromkeys(texts) if t not in found]
+        if todo:
+            fresh = dict(zip(todo, self.embeddings.embed_documents(todo)))
+            self.cache.put_many(self.model, fresh)
+            found.update(fresh)
+        return [found[t] for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        vec = self.cache.get(self.model, text)
+        if vec is None:
+            vec = self.embeddings.embed_query(text)
+            self.cache.put_many(self.model, {text: vec})
+        return vec
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # SQLite reads and commits block, so they run off the event loop
+        found = await asyncio.to_thread(self.cache.get_many, self.model, texts)
+        todo = [t for t in dict.fromkeys(texts) if t not in found]
+        if todo:
+            fresh = dict(zip(todo, await self.embeddings.aembed_documents(todo)))
+            await asyncio.to_thread(self.cache.put_many, self.model, fresh)
+            found.update(fresh)
+        return [found[t] for t in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Process-wide cache shared by all Streamlit sessions."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
@@ -0,0 +1,479 @@
+import os
+from typing import Any, AsyncIterator, Dict, List, MutableMapping, Optional
+from dotenv import load_dotenv
+from cohort import COHORT_QUERIES, acohort_context, is_cohort_query
+from context_budget import (CONTEXT_HISTORY_TOKENS, CONTEXT_TOKEN_BUDGET, MESSAGE_OVERHEAD,
+                            allocate_chunks, count_tokens, fit_history)
+from llm_clients import get_chat_model
+from orchestrator import aroute_and_prefetch, run
+from patient_facts import (STRUCTURED_FACTS, afetch_facts, format_facts, requested_attributes,
+                           structured_only)
+from query_analyzer import PRONOUN_PATTERN, scan_patient_mentions
+from retrieve_supabase import amatch_patient_chunks, amatch_patient_chunks_batch
+
+load_dotenv()
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+# Messages kept in the conversation history (older ones are dropped)
+CHAT_HISTORY_RETENTION = int(os.getenv("CHAT_HISTORY_RETENTION", "200"))
+
+# Conversation state used by the engine. Any mutable mapping works:
+# st.session_state in the Streamlit app, a plain dict in the HTTP API.
+STATE_DEFAULTS = {
+    "locked_patient": None,
+    "active_patients": [],  # For multi-patient queries
+    "messages": [],
+    "awaiting_disambiguation": None,
+}
+
+COHORT_SYSTEM = ("You are a clinical data analyst. The context holds statistics computed over "
+                 "the structured records of the whole patient roster. Answer using ONLY those "
+                 "numbers, say which filters they reflect, and do not invent patients or values.")
+
+
+def init_state(state: MutableMapping[str, Any]) -> MutableMapping[str, Any]:
+    for key, default in STATE_DEFAULTS.items():
+        if key not in state:
+            state[key] = list(default) if isinstance(default, list) else default
+    return state
+
+
+def add_message(state: MutableMapping[str, Any], role: str, content: str) -> None:
+    """Appends to the history, keeping at most CHAT_HISTORY_RETENTION messages."""
+    state["messages"].append({"role": role, "content": content})
+    if CHAT_HISTORY_RETENTION > 0 and len(state["messages"]) > CHAT_HISTORY_RETENTION:
+        del state["messages"][:-CHAT_HISTORY_RETENTION]
+
+
+def _reply(state: MutableMapping[str, Any], response: str,
+           analysis: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Records an assistant reply that needs no LLM call."""
+    add_message(state, "assistant", response)
+    return {"reply": response, "messages": [], "sources": [], "analysis": analysis}
+
+
+def _resolve_disambiguation(state: MutableMapping[str, Any], prompt: str) -> Dict[str, Any]:
+    # User is responding to disambiguation
+    user_choice = prompt.strip().lower()
+    candidates = state["awaiting_disambiguation"]
+
+    # Try to match user's choice
+    selected = None
+    for idx, candidate in enumerate(candidates):
+        # Check if user typed a number (1, 2, etc.)
+        if user_choice == str(idx + 1):
+            selected = candidate
+            break
+        # Check if user typed the patient ID
+        if user_choice == candidate['patient_id'].lower():
+            selected = candidate
+            break
+        # Check if user typed part of the name
+        full_name = f"{candidate['first_name']} {candidate['last_name']}".lower()
+        if user_choice in full_name or full_name in user_choice:
+            selected = candidate
+            break
+
+    if selected:
+        state["locked_patient"] = selected
+        state["awaiting_disambiguation"] = None
+        return _reply(state, f"✅ Locked to patient **{selected['first_name']} {selected['last_name']}** (DOB: {selected['dob']}). What would you like to know?")
+    return _reply(state, "I couldn't match your selection. Please try again by typing the number, patient ID, or name.")
+
+
+def _retrieval_query(prompt: str) -> str:
+    # For multi-patient queries, retrieve more chunks per patient to ensure we get relevant data
+    # Create a patient-agnostic query to avoid bias towards specific patient names
+    query_lower = prompt.lower()
+
+    # Extract the specific attribute being asked about (height, weight, etc.) without patient names
+    # This ensures equal retrieval quality for all patients
+    if "height" in query_lower:
+        # Use generic height query without patient names for better matching
+        return "height measurement cm"
+    elif "weight" in query_lower:
+        return "weight measurement kg"
+    elif "blood pressure" in query_lower or "bp" in query_lower:
+        return "blood pressure measurement"
+    elif "temperature" in query_lower or "temp" in query_lower:
+        return "temperature measurement"
+    elif "bmi" in query_lower:
+        return "bmi body mass index"
+    elif any(term in query_lower for term in ["compare", "comparison", "difference"]):
+        # For general comparison queries, extract what's being compared
+        # Try to find measurement terms
+        if any(term in query_lower for term in ["vital", "lab", "test", "result"]):
+            return "patient measurement data"
+        return "patient information data"
+    # Use the original query but remove patient names for better matching
+    # Keep only the attribute/measurement terms
+    return prompt
+
+
+async def _amulti_patient_context(prompt: str, patients: List[Dict[str, str]]):
+    retrieval_query = _retrieval_query(prompt)
+
+    # Build every retrieval strategy for every patient up front so they
+    # resolve in one batched call (patients fetched concurrently)
+    # instead of one round trip each
+    batch_requests = []
+    for patient in patients:
+        pid = patient["patient_id"]
+        # Strategy 1: Use patient-agnostic attribute query (retrieve more chunks)
+        batch_requests.append((retrieval_query, pid, 20))
+        # Strategy 2: Also try with patient name included
+        batch_requests.append((f"{patient['first_name']} {retrieval_query}", pid, 15))
+        # Strategy 3: General patient data as fallback (retrieve more)
+        batch_requests.append(("patient information data", pid, 15))
+        # Strategy 4: If asking about height, also try very specific height queries
+        if "height" in prompt.lower():
+            height_queries = [
+                f"{patient['first_name']} height",
+                "height cm",
+                f"height {patient['first_name']}"
+            ]
+            for hq in height_queries:
+                batch_requests.append((hq, pid, 10))
+
+    # Store chunks per patient first, then interleave them
+    patient_chunks = {}
+    batch_hits = await amatch_patient_chunks_batch(batch_requests)
+    for patient in patients:
+        patient_name = f"{patient['first_name']} {patient['last_name']}"
+        patient_hits = []
+        seen_chunk_ids = set()
+        for hits in batch_hits.get(patient["patient_id"], []):
+            for h in hits:
+                chunk_id = h.get("id") or h.get("content", "")[:50]
+                if chunk_id not in seen_chunk_ids:
+                    seen_chunk_ids.add(chunk_id)
+                    patient_hits.append((h, patient_name))
+        patient_chunks[patient_name] = patient_hits
+
+    # Verify we have chunks for all patients - if not, do emergency retrieval
+    missing_patients = [
+        p for p in patients
+        if not patient_chunks.get(f"{p['first_name']} {p['last_name']}")
+    ]
+    if missing_patients:
+        # Emergency: try multiple very broad queries, batched across patients
+        emergency_requests = []
+        for patient in missing_patients:
+            emergency_queries = [
+                patient['first_name'],
+                patient['patient_id'],
+                f"{patient['first_name']} {patient['last_name']}",
+                "patient data"
+            ]
+            for eq in emergency_queries:
+                emergency_requests.append((eq, patient["patient_id"], 15))
+        emergency_batch = await amatch_patient_chunks_batch(emergency_requests)
+        for patient in missing_patients:
+            patient_name = f"{patient['first_name']} {patient['last_name']}"
+            emergency_hits = []
+            for hits in emergency_batch.get(patient["patient_id"], []):
+                emergency_hits.extend(hits)
+                if len(emergency_hits) >= 15:
+                    break
+            # Deduplicate
+            seen = set()
+            for h in emergency_hits:
+                chunk_id = h.get("id") or h.get("content", "")[:50]
+                if chunk_id not in seen:
+                    seen.add(chunk_id)
+                    if patient_name not in patient_chunks:
+                        patient_chunks[patient_name] = []
+                    patient_chunks[patient_name].append((h, patient_name))
+
+    # Chunks stay grouped per patient (in rank order); build_messages fits
+    # them into the token budget and interleaves them
+    context = {}
+    sources = []
+    for patient in patients:
+        patient_name = f"{patient['first_name']} {patient['last_name']}"
+        chunks = patient_chunks.get(patient_name, [])
+        context[patient_name] = [f"[{pname}]: {h['content']}" for h, pname in chunks]
+        sources.extend(h.get("metadata") for h, _ in chunks)
+
+    return context, sources
+
+
+async def _astructured_context(prompt: str, patients: List[Dict[str, str]]):
+    """
+    Answers comparisons on extracted attributes (height, AMH, medications, ...)
+    from the patient_facts table in one query. Patients without stored values
+    for every requested attribute fall back to vector retrieval, and so does
+    everyone when the question also asks about something unstructured.
+    """
+    requested = requested_attributes(prompt) if STRUCTURED_FACTS else {}
+    facts = {}
+    if requested:
+        try:
+            facts = await afetch_facts([p["patient_id"] for p in patients],
+                                       [a for attrs in requested.values() for a in attrs])
+        except Exception:
+            # patient_facts migration not applied - use retrieval only
+            facts = {}
+
+    def covered(patient):
+        if not requested or patient["patient_id"] not in facts:
+            return False
+        have = {row["attribute"] for row in facts[patient["patient_id"]]}
+        return all(have.intersection(attrs) for attrs in requested.values())
+
+    names = [f"{p['first_name']} {p['last_name']}" for p in patients]
+    if requested and structured_only(prompt, names):
+        rest = [p for p in patients if not covered(p)]
+    else:
+        rest = list(patients)
+    context, sources = await _amulti_patient_context(prompt, rest) if rest else ({}, [])
+    ordered = {}
+    for patient, patient_name in zip(patients, names):
+        rows = facts.get(patient["patient_id"], [])
+        blocks = [format_facts(patient_name, rows)] if rows else []
+        ordered[patient_name] = blocks + context.get(patient_name, [])
+        if rows:
+            sources.append({"patient_id": patient["patient_id"], "source": "patient_facts",
+                            "chunk_ids": sorted({row["chunk_id"] for row in rows})})
+    return ordered, sources
+
+
+def _multi_patient_system(prompt: str, patients: List[Dict[str, str]]) -> str:
+    # Build explicit patient list for the prompt
+    patient_list = "\n".join([f"- {p['first_name']} {p['last_name']} (ID: {p['patient_id']})" for p in patients])
+    patient_names = ", ".join([f"{p['first_name']} {p['last_name']}" for p in patients])
+
+    # Extract what attribute is being asked about
+    attribute = "the requested information"
+    if "height" in prompt.lower():
+        attribute = "height"
+    elif "weight" in prompt.lower():
+        attribute = "weight"
+    elif "blood pressure" in prompt.lower() or "bp" in prompt.lower():
+        attribute = "blood pressure"
+
+    return f"""You are a clinical assistant. You have been asked to compare information for these patients:
+{patient_list}
+
+The context below contains interleaved data chunks from ALL patients. Each chunk is labeled with [Patient Name]: to identify which patient it belongs to.
+
+CRITICAL INSTRUCTIONS:
+1. You MUST extract {attribute} for EACH of these patients: {patient_names}
+2. Search through ALL chunks in the context - data is interleaved, so look for chunks labeled with each patient's name
+3. For each patient, find their {attribute} value in the chunks labeled with their name
+4. If you find {attribute} for a patient, use it in your comparison
+5. If you cannot find {attribute} for a specific patient after searching ALL their labeled chunks, then and only then state that it's missing
+6. Present your answer comparing ALL patients mentioned: {patient_names}
+
+Remember: The context summary at the top shows how many chunks you have for each patient. Use ALL of them."""
+
+
+def _interleave(groups: Dict[str, List[str]]) -> List[str]:
+    # Take one chunk from each patient in round-robin fashion so the LLM
+    # doesn't focus only on the first patient's data
+    out = []
+    for i in range(max((len(chunks) for chunks in groups.values()), default=0)):
+        for chunks in groups.values():
+            if i < len(chunks):
+                out.append(chunks[i])
+    return out
+
+
+def _context_summary(groups: Dict[str, List[str]]) -> str:
+    # Summary header showing what we have for each patient
+    summary_parts = [f"{name}: {len(chunks)} data chunks" for name, chunks in groups.items()]
+    return f"CONTEXT SUMMARY: {' | '.join(summary_parts)}\n\n"
+
+
+def build_messages(state: MutableMapping[str, Any], prompt: str, system: str,
+                   context: Dict[str, List[str]]) -> List[Dict[str, str]]:
+    """
+    Builds the chat messages for one query within CONTEXT_TOKEN_BUDGET tokens.
+    `context` maps patient name to ranked chunks ({} for general queries).
+    The system prompt and question always fit; history gets up to
+    CONTEXT_HISTORY_TOKENS and the rest is shared fairly between patients.
+    """
+    has_context = any(context.values())
+    question = f"QUESTION: {prompt}\nAnswer:" if has_context else prompt
+    budget = (CONTEXT_TOKEN_BUDGET
+              - count_tokens(system, LLM_MODEL) - count_tokens(question, LLM_MODEL)
+              - 2 * MESSAGE_OVERHEAD)
+
+    # Conversation memory: up to the last 7 messages before this prompt
+    recent_history = state["messages"][-8:-1] if len(state["messages"]) > 1 else []
+    history = fit_history(recent_history, min(CONTEXT_HISTORY_TOKENS, max(budget, 0)), LLM_MODEL)
+    budget -= sum(count_tokens(m["content"], LLM_MODEL) + MESSAGE_OVERHEAD for m in history)
+
+    messages = [{"role": "system", "content": system}]
+    for msg in history:
+        messages.append({"role": msg["role"], "content": msg["content"]})
+
+    # Add current query with context (only for patient-specific queries)
+    if has_context:
+        # Patient-specific query - include context from Supabase
+        separator = "\n---\n"
+        budget -= count_tokens("CONTEXT:\n\n\n", LLM_MODEL)
+        multi = len(context) >= 2
+        if multi:
+            # Reserve room for the summary header (counts only shrink)
+            budget -= count_tokens(_context_summary(context) + separator, LLM_MODEL)
+        fitted = allocate_chunks(context, budget, LLM_MODEL,
+                                 separator_tokens=count_tokens(separator, LLM_MODEL))
+        blocks = _interleave(fitted)
+        if multi:
+            blocks.insert(0, _context_summary(fitted))
+        ctx_block = separator.join(blocks)
+        messages.append({
+            "role": "user",
+            "content": f"CONTEXT:\n{ctx_block}\n\n{question}"
+        })
+    else:
+        # General query - no context, use ChatGPT's knowledge directly
+        messages.append({
+            "role": "user",
+            "content": question
+        })
+    return messages
+
+
+async def aprepare_query(prompt: str,
+                         roster: List[Dict[str, str]],
+                         state: MutableMapping[str, Any]) -> Dict[str, Any]:
+    """
+    Runs routing, retrieval and context assembly for one user prompt and
+    updates the conversation state (locks, active patients, history).
+
+    Returns a dict with:
+      reply: final assistant text when no LLM call is needed (disambiguation,
+             patient not found, ...), already recorded in state; else None
+      messages: chat messages to send to the LLM when reply is None
+      sources: metadata of the retrieved chunks
+      analysis: the routing analysis (None for disambiguation answers)
+    """
+    init_state(state)
+    # Add user message
+    add_message(state, "user", prompt)
+
+    # Check if awaiting disambiguation response
+    if state["awaiting_disambiguation"]:
+        return _resolve_disambiguation(state, prompt)
+
+    # Roster-wide aggregates ("how many patients on Letrozole have AMH < 1")
+    # are computed from structured facts; no routing or vector search
+    if COHORT_QUERIES and is_cohort_query(prompt):
+        hits, leftover, _ = scan_patient_mentions(prompt, roster)
+        # ("her AMH" with a locked patient stays a patient question)
+        if not hits and not leftover and not (state["locked_patient"] and PRONOUN_PATTERN.search(prompt)):
+            try:
+                cohort = await acohort_context(prompt, roster)
+            except Exception:
+                # patient_facts migration not applied - answer as usual
+                cohort = None
+            if cohort is not None:
+                sections, source = cohort
+                analysis = {"intent": "cohort", "confidence": 1.0, "resolved_patient": None,
+                            "resolved_patients": [], "candidates": []}
+                return {
+                    "reply": None,
+                    "messages": build_messages(state, prompt, COHORT_SYSTEM, {"Cohort": sections}),
+                    "sources": [source],
+                    "analysis": analysis
+                }
+
+    # Use LLM-based routing, speculatively retrieving for the likely patient
+    # at the same time (prefetched is None if routing picked someone else)
+    analysis, prefetched = await aroute_and_prefetch(prompt, roster, state["locked_patient"])
+
+    # Handle different routing scenarios
+    if analysis.get("resolved_patients") and len(analysis["resolved_patients"]) >= 2:
+        # Multi-patient query - retrieve context for all patients
+        patients = analysis["resolved_patients"]
+
+        # Set active patients for UI display
+        state["active_patients"] = patients
+        state["locked_patient"] = None  # Clear single patient lock
+
+        context, sources = await _astructured_context(prompt, patients)
+        system = _multi_patient_system(prompt, patients)
+
+    elif analysis["resolved_patient"] or analysis["intent"] == "patient_specific_use_locked":
+        if analysis["resolved_patient"]:
+            # Unique patient found - lock to it
+            patient = analysis["resolved_patient"]
+
+            # Only update lock if it's a different patient
+            if not state["locked_patient"] or state["locked_patient"]['patient_id'] != patient['patient_id']:
+                state["locked_patient"] = patient
+                # Set as single active patient
+                state["active_patients"] = [patient]
+        else:
+            # Using locked patient context
+            patient = state["locked_patient"]
+            # Ensure active_patients is set
+            if not state["active_patients"]:
+                state["active_patients"] = [patient]
+
+        # Get patient context
+        if prefetched is not None:
+            hits = prefetched
+        else:
+            hits = await amatch_patient_chunks(prompt, patient["patient_id"], k=6)
+
+        context = {f"{patient['first_name']} {patient['last_name']}": [h["content"] for h in hits]}
+        sources = [h["metadata"] for h in hits]
+        system = f"You are a clinical assistant. Use ONLY the retrieved patient context for {patient['first_name']} {patient['last_name']}."
+
+    elif analysis["candidates"]:
+        # Multiple patients found - ask for clarification
+        state["awaiting_disambiguation"] = analysis["candidates"]
+        response = f"I found multiple patients matching '{analysis['patient_reference']}'. Did you mean:\n\n"
+        for idx, candidate in enumerate(analysis["candidates"]):
+            response += f"{idx + 1}. **{candidate['first_name']} {candidate['last_name']}** (DOB: {candidate['dob']}, ID: `{candidate['patient_id']}`)\n"
+        response += "\nPlease type the number, patient ID, or full name to select."
+        return _reply(state, response, analysis)
+
+    elif analysis["intent"] == "patient_specific_no_context":
+        # Patient-specific query but no patient locked or found
+        return _reply(state, "It seems you're asking about a specific patient, but I need to know which patient. Could you please mention the patient's name or ID?", analysis)
+
+    elif analysis["intent"] == "patient_specific_not_found":
+        # Patient name detected but not in roster
+        unresolved = analysis.get("unresolved_refs", [])
+        if unresolved:
+            unresolved_str = ", ".join(unresolved)
+            response = f"I couldn't find patient(s) matching '{unresolved_str}' in the system. Please check the names or IDs and try again."
+        else:
+            response = f"I couldn't find a patient matching '{analysis.get('patient_reference', 'the mentioned patient')}' in the system. Please check the name or ID and try again."
+        return _reply(state, response, analysis)
+
+    else:
+        # General medical query - use ChatGPT's knowledge directly (no Supabase retrieval)
+        context = {}  # No context from Supabase for general queries
+        sources = []  # No sources for general queries
+        system = "You are a medical knowledge assistant. Use your training knowledge to answer general medical questions. Provide accurate, evidence-based information."
+
+    return {
+        "reply": None,
+        "messages": build_messages(state, prompt, system, context),
+        "sources": sources,
+        "analysis": analysis
+    }
+
+
+def prepare_query(prompt: str,
+                  roster: List[Dict[str, str]],
+                  state: MutableMapping[str, Any]) -> Dict[str, Any]:
+    """Synchronous aprepare_query, run on the orchestrator event loop."""
+    return run(aprepare_query(prompt, roster, state))
+
+
+async def astream_answer(messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """Streams the chat model's answer as text deltas."""
+    chat = get_chat_model(LLM_MODEL)
+    async for chunk in chat.astream(messages):
+        if chunk.content:
+            yield chunk.content
+
+
+def record_answer(state: MutableMapping[str, Any], answer: str) -> None:
+    # Save response
+    add_message(state, "assistant", answer)
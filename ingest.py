@@ -0,0 +1,389 @@
+import os
+import sys
+import json
+import time
+import re
+import hashlib
+import asyncio
+import argparse
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from dotenv import load_dotenv
+from context_budget import count_tokens
+from ingest_journal import JOURNAL_PATH, IngestJournal
+from llm_clients import acall_with_backoff, get_embeddings, retry_delay
+from patient_facts import astore_facts
+from patients import mget
+from supabase_client import acreate_service_supabase
+
+load_dotenv()
+EMBED_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Chunking
+INGEST_CHUNK_CHARS = int(os.getenv("INGEST_CHUNK_CHARS", "2000"))
+INGEST_CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "200"))
+# Embedding: texts and tokens per request, concurrent requests, and the
+# account's tokens-per-minute limit for the embedding model
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "256"))
+INGEST_EMBED_BATCH_TOKENS = int(os.getenv("INGEST_EMBED_BATCH_TOKENS", "100000"))
+INGEST_EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "4"))
+INGEST_TPM = int(os.getenv("INGEST_TPM", "1000000"))
+# Inserts: rows per request, concurrent writers, retries per batch
+INGEST_INSERT_BATCH = int(os.getenv("INGEST_INSERT_BATCH", "200"))
+INGEST_INSERT_WORKERS = int(os.getenv("INGEST_INSERT_WORKERS", "2"))
+INGEST_INSERT_RETRIES = int(os.getenv("INGEST_INSERT_RETRIES", "5"))
+
+TEXT_EXTENSIONS = (".txt", ".md")
+# Per-directory metadata inherited by every document below it
+DIR_METADATA = "_metadata.json"
+# Collapsed for content hashes (sql/rag_chunks_content_hash.sql uses the same set)
+ASCII_WHITESPACE = re.compile(r"[ \t\n\r\f\v]+")
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def iter_documents(source: str,
+                   skip: Set[str] = frozenset()) -> Iterator[Tuple[str, str, Dict[str, Any]]]:
+    """
+    Yields (doc_key, text, metadata) lazily from a JSONL file ({"content",
+    "metadata"} per line) or a directory of .txt/.md files. In a directory,
+    metadata comes from _metadata.json files on the way down plus an optional
+    <name>.json next to each file; doc_id defaults to the relative path.
+    Documents whose doc_key is in `skip` are not read.
+    """
+    if os.path.isfile(source):
+        with open(source, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                doc_key = hashlib.sha256(line.strip().encode("utf-8")).hexdigest()
+                if doc_key in skip:
+                    continue
+                record = json.loads(line)
+                text = record.get("content") or record.get("text") or ""
+                md = record.get("metadata") or {k: v for k, v in record.items()
+                                                if k not in ("content", "text")}
+                yield doc_key, text, md
+        return
+
+    inherited: Dict[str, Dict[str, Any]] = {}
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        md = dict(inherited.get(os.path.dirname(root), {}))
+        if DIR_METADATA in files:
+            md.update(_read_json(os.path.join(root, DIR_METADATA)))
+        inherited[root] = md
+        for name in sorted(files):
+            if not name.endswith(TEXT_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, source)
+            st = os.stat(path)
+            doc_md = dict(md, doc_id=rel)
+            sidecar = os.path.splitext(path)[0] + ".json"
+            if os.path.exists(sidecar):
+                doc_md.update(_read_json(sidecar))
+            # A file whose text or metadata (sidecar, inherited _metadata.json)
+            # changed since it was ingested is processed again
+            md_hash = hashlib.sha256(
+                json.dumps(doc_md, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+            doc_key = f"{rel}:{st.st_size}:{st.st_mtime_ns}:{md_hash}"
+            if doc_key in skip:
+                continue
+            with open(path, encoding="utf-8") as f:
+                yield doc_key, f.read(), doc_md
+
+
+def chunk_text(text: str, max_chars: int = INGEST_CHUNK_CHARS,
+               overlap: int = INGEST_CHUNK_OVERLAP) -> List[str]:
+    """Packs paragraphs into chunks of at most max_chars; long paragraphs are split with overlap."""
+    pieces: List[str] = []
+    for para in (p.strip() for p in text.split("\n\n")):
+        if not para:
+            continue
+        while len(para) > max_chars:
+            cut = para.rfind(" ", 0, max_chars)
+            cut = cut if cut > max_chars // 2 else max_chars
+            pieces.append(para[:cut])
+            para = para[max(cut - overlap, 0):].lstrip() if overlap < cut else para[cut:]
+        pieces.append(para)
+
+    chunks: List[str] = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 2 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_hash(metadata: Dict[str, Any], text: str) -> str:
+    """Stable identity of a chunk: sha256(patient_id, doc_id, whitespace-normalized text)."""
+    # ASCII whitespace only, exactly as the SQL backfill normalizes
+    normalized = ASCII_WHITESPACE.sub(" ", text).strip(" ")
+    key = "\x1f".join((mget(metadata, "patient_id"), str(metadata.get("doc_id", "")), normalized))
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def iter_chunks(source: str,
+                on_document: Callable[[str, int], None] = lambda key, n: None,
+                skip: Set[str] = frozenset()) -> Iterator[Dict[str, Any]]:
+    """Chunk rows of every document; on_document(doc_key, n_chunks) runs before its chunks."""
+    for doc_key, text, md in iter_documents(source, skip):
+        chunks = chunk_text(text)
+        on_document(doc_key, len(chunks))
+        for i, chunk in enumerate(chunks):
+            chunk_md = dict(md, chunk_index=i)
+            yield {"content": chunk, "metadata": chunk_md,
+                   "content_hash": chunk_hash(chunk_md, chunk), "_doc": doc_key}
+
+
+async def existing_hashes(sb, hashes: List[str]) -> set:
+    """Hashes already stored in rag_chunks (sql/rag_chunks_content_hash.sql)."""
+    res = await sb.rpc("existing_content_hashes", {"hashes": hashes}).execute()
+    return {h if isinstance(h, str) else next(iter(h.values())) for h in (res.data or [])}
+
+
+async def refresh_metadata(sb, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Updates the metadata of already stored chunks where it changed; returns
+    the updated rows ({id, content, metadata}).
+    """
+    rows = [{"content_hash": c["content_hash"], "metadata": c["metadata"]} for c in chunks]
+    res = await sb.rpc("refresh_chunk_metadata", {"rows": rows}).execute()
+    return [r if "id" in r else next(iter(r.values())) for r in (res.data or [])]
+
+
+def iter_embed_batches(chunks: Iterator[Dict[str, Any]],
+                       max_items: int = INGEST_EMBED_BATCH,
+                       max_tokens: int = INGEST_EMBED_BATCH_TOKENS) -> Iterator[Tuple[List[Dict[str, Any]], int]]:
+    """Groups chunks into embedding requests bounded by item count and tokens."""
+    batch: List[Dict[str, Any]] = []
+    tokens = 0
+    for chunk in chunks:
+        n = count_tokens(chunk["content"], EMBED_MODEL)
+        if batch and (len(batch) >= max_items or tokens + n > max_tokens):
+            yield batch, tokens
+            batch, tokens = [], 0
+        batch.append(chunk)
+        tokens += n
+    if batch:
+        yield batch, tokens
+
+
+class TokenRateLimiter:
+    """Token bucket refilled at tokens_per_minute; acquire() waits for capacity."""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self.tokens = self.capacity
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, n: int) -> None:
+        n = min(float(n), self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                await asyncio.sleep((n - self.tokens) / self.rate)
+
+
+async def _insert_with_retries(sb, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    attempt = 0
+    while True:
+        try:
+            # Idempotent: rows whose content_hash is already stored are skipped
+            res = await sb.table("rag_chunks").upsert(
+                rows, on_conflict="content_hash", ignore_duplicates=True
+            ).select("id", "content", "metadata").execute()
+            return res.data or []
+        except Exception as e:
+            if attempt >= INGEST_INSERT_RETRIES:
+                raise
+            await asyncio.sleep(retry_delay(e, attempt))
+            attempt += 1
+
+
+async def aingest(source: str, facts: bool = True,
+                  progress: Optional[Any] = sys.stderr,
+                  journal: Optional[IngestJournal] = None) -> Dict[str, int]:
+    """
+    Streams documents from `source` through chunking, batched concurrent
+    embedding (rate limited to INGEST_TPM) and bounded, retried inserts into
+    rag_chunks. Queues between the stages are bounded, so memory stays flat
+    however large the input is.
+
+    Progress is checkpointed in `journal`: embedded rows are persisted until
+    their insert succeeds and finished documents are recorded, so a restart
+    inserts the leftovers and continues with the first unfinished document.
+    """
+    owns_journal = journal is None
+    journal = journal or IngestJournal()
+    try:
+        return await _aingest(source, facts, progress, journal)
+    finally:
+        if owns_journal:
+            journal.close()
+
+
+async def _aingest(source: str, facts: bool, progress: Optional[Any],
+                   journal: IngestJournal) -> Dict[str, int]:
+    source_key = os.path.abspath(source)
+    sb = await acreate_service_supabase()
+    embeddings = get_embeddings(EMBED_MODEL, max_retries=0)  # acall_with_backoff retries
+    limiter = TokenRateLimiter(INGEST_TPM)
+    done = journal.done_documents(source_key)
+    stats = {"documents": 0, "resumed": len(done), "recovered": 0, "chunks": 0,
+             "skipped": 0, "inserted": 0, "metadata_updated": 0, "facts": 0}
+    seen: set = set()  # hashes queued in this run
+    # hash queued in this run -> repeats of it waiting for that copy to be journaled
+    waiting: Dict[str, List[Dict[str, Any]]] = {}
+    # doc_key -> [chunks not yet stored or journaled, total chunks]
+    outstanding: Dict[str, List[int]] = {}
+    started = time.monotonic()
+    embed_q: "asyncio.Queue[Optional[Tuple[List[Dict[str, Any]], int]]]" = asyncio.Queue(INGEST_EMBED_WORKERS * 2)
+    insert_q: "asyncio.Queue[Optional[List[Dict[str, Any]]]]" = asyncio.Queue(INGEST_INSERT_WORKERS * 2)
+
+    async def write(rows: List[Dict[str, Any]]) -> None:
+        inserted = await _insert_with_retries(sb, rows)
+        journal.clear_pending([r["content_hash"] for r in rows])
+        stats["chunks"] += len(rows)
+        stats["inserted"] += len(inserted)
+        if facts:
+            # Typed vitals/labs/medications for structured queries
+            stats["facts"] += await astore_facts(sb, inserted)
+
+    # Embeddings computed by an interrupted run go in first
+    for rows in journal.iter_pending(INGEST_INSERT_BATCH):
+        await write(rows)
+        stats["recovered"] += len(rows)
+
+    def on_document(doc_key: str, n_chunks: int) -> None:
+        stats["documents"] += 1
+        if n_chunks:
+            outstanding[doc_key] = [n_chunks, n_chunks]
+        else:
+            journal.mark_done(source_key, doc_key, 0)
+
+    def settle(chunks: List[Dict[str, Any]]) -> None:
+        # A document is finished once every chunk is stored or journaled
+        for c in chunks:
+            entry = outstanding[c["_doc"]]
+            entry[0] -= 1
+            if entry[0] == 0:
+                journal.mark_done(source_key, c["_doc"], entry[1])
+                del outstanding[c["_doc"]]
+
+    async def produce() -> None:
+        # Reading and chunking files happens in a worker thread, which only
+        # collects the documents it started; they are registered here on the
+        # loop, before the batch holding their first chunks is queued
+        started: List[Tuple[str, int]] = []
+        batches = iter_embed_batches(iter_chunks(source, lambda *doc: started.append(doc), done))
+        while True:
+            batch = await asyncio.to_thread(next, batches, None)
+            for doc_key, n_chunks in started:
+                on_document(doc_key, n_chunks)
+            started.clear()
+            if batch is None:
+                break
+            await embed_q.put(batch)
+        for _ in range(INGEST_EMBED_WORKERS):
+            await embed_q.put(None)
+
+    async def embed() -> None:
+        while (item := await embed_q.get()) is not None:
+            batch, tokens = item
+            # Skip chunks already stored (or repeated in this run) before paying for embeddings
+            stored = await existing_hashes(sb, [c["content_hash"] for c in batch])
+            todo, written = [], []
+            for c in batch:
+                h = c["content_hash"]
+                if h in stored or h in seen:
+                    stats["skipped"] += 1
+                    # A repeat of a chunk queued in this run is only settled
+                    # once that copy is journaled
+                    if h not in stored and h in waiting:
+                        waiting[h].append(c)
+                    else:
+                        written.append(c)
+                else:
+                    seen.add(h)
+                    waiting[h] = []
+                    todo.append(c)
+            unchanged = [c for c in batch if c["content_hash"] in stored]
+            if unchanged:
+                # Same text, possibly edited metadata (sidecar, _metadata.json);
+                # facts take their patient and date from it, so re-derive them
+                updated = await refresh_metadata(sb, unchanged)
+                stats["metadata_updated"] += len(updated)
+                if facts and updated:
+                    stats["facts"] += await astore_facts(sb, updated)
+            settle(written)
+            if not todo:
+                continue
+            if len(todo) < len(batch):
+                tokens = sum(count_tokens(c["content"], EMBED_MODEL) for c in todo)
+            await limiter.acquire(tokens)
+            texts = [c["content"] for c in todo]
+            vecs = await acall_with_backoff(lambda: embeddings.aembed_documents(texts))
+            rows = [{k: v for k, v in c.items() if k != "_doc"} | {"embedding": vec}
+                    for c, vec in zip(todo, vecs)]
+            # Persist before inserting so a crash never loses paid-for embeddings
+            journal.add_pending(rows)
+            settle(todo + [r for c in todo for r in waiting.pop(c["content_hash"])])
+            for i in range(0, len(rows), INGEST_INSERT_BATCH):
+                await insert_q.put(rows[i:i + INGEST_INSERT_BATCH])
+
+    async def insert() -> None:
+        while (rows := await insert_q.get()) is not None:
+            await write(rows)
+            if progress is not None:
+                rate = stats["inserted"] / max(time.monotonic() - started, 1e-6) * 3600
+                print(f"{stats['documents']} documents, {stats['inserted']} chunks inserted, "
+                      f"{stats['skipped']} unchanged ({rate:,.0f} chunks/h)", file=progress, flush=True)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(produce())
+        embedders = [tg.create_task(embed()) for _ in range(INGEST_EMBED_WORKERS)]
+        writers = [tg.create_task(insert()) for _ in range(INGEST_INSERT_WORKERS)]
+        await asyncio.gather(*embedders)
+        for _ in writers:
+            await insert_q.put(None)
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bulk-load clinical documents into rag_chunks.")
+    parser.add_argument("source", help="directory of .txt/.md files or a JSONL file")
+    parser.add_argument("--no-facts", action="store_true",
+                        help="skip structured fact extraction (patient_facts)")
+    parser.add_argument("--journal", default=JOURNAL_PATH,
+                        help="checkpoint journal used to resume interrupted runs")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore finished documents recorded in the journal")
+    args = parser.parse_args()
+    journal = IngestJournal(args.journal)
+    if args.restart:
+        journal.reset(os.path.abspath(args.source))
+    try:
+        stats = asyncio.run(aingest(args.source, facts=not args.no_facts, journal=journal))
+    finally:
+        journal.close()
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
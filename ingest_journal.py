@@ -0,0 +1,92 @@
+import os
+import json
+import sqlite3
+import threading
+from array import array
+from typing import Any, Dict, Iterator, List, Set
+from dotenv import load_dotenv
+
+load_dotenv()
+JOURNAL_PATH = os.getenv("INGEST_JOURNAL", ".cache/ingest_journal.sqlite3")
+
+
+class IngestJournal:
+    """
+    Local checkpoint journal for ingest.py, in SQLite:
+      documents: source documents whose chunks are all stored or journaled
+      pending:   embedded rows not yet confirmed inserted (float32 vectors)
+    A restarted ingestion skips finished documents and inserts pending rows
+    first, so no embedding is paid for twice.
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "source TEXT NOT NULL, doc_key TEXT NOT NULL, chunks INTEGER NOT NULL, "
+            "PRIMARY KEY (source, doc_key))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pending ("
+            "content_hash TEXT PRIMARY KEY, row TEXT NOT NULL, vec BLOB NOT NULL)")
+        self._db.commit()
+
+    def done_documents(self, source: str) -> Set[str]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT doc_key FROM documents WHERE source = ?", (source,)).fetchall()
+        return {key for key, in rows}
+
+    def mark_done(self, source: str, doc_key: str, chunks: int) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO documents (source, doc_key, chunks) VALUES (?, ?, ?)",
+                (source, doc_key, chunks))
+            self._db.commit()
+
+    def add_pending(self, rows: List[Dict[str, Any]]) -> None:
+        """Persists embedded rows ({content, metadata, content_hash, embedding}) before insert."""
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO pending (content_hash, row, vec) VALUES (?, ?, ?)",
+                [(r["content_hash"],
+                  json.dumps({k: v for k, v in r.items() if k != "embedding"}),
+                  array("f", r["embedding"]).tobytes()) for r in rows])
+            self._db.commit()
+
+    def clear_pending(self, hashes: List[str]) -> None:
+        with self._lock:
+            self._db.executemany("DELETE FROM pending WHERE content_hash = ?",
+                                 [(h,) for h in hashes])
+            self._db.commit()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def iter_pending(self, batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+        """Pending rows in batches, with their embeddings restored."""
+        after = ""
+        while True:
+            with self._lock:
+                page = self._db.execute(
+                    "SELECT content_hash, row, vec FROM pending WHERE content_hash > ? "
+                    "ORDER BY content_hash LIMIT ?", (after, batch_size)).fetchall()
+            if not page:
+                return
+            yield [dict(json.loads(row), embedding=array("f", vec).tolist())
+                   for _, row, vec in page]
+            after = page[-1][0]
+
+    def reset(self, source: str) -> None:
+        """Forgets finished documents of `source` (pending embeddings are kept)."""
+        with self._lock:
+            self._db.execute("DELETE FROM documents WHERE source = ?", (source,))
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
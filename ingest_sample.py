@@ -3,6 +3,8 @@ import os
 from dotenv import load_dotenv
 from supabase import create_client
 from langchain_openai import OpenAIEmbeddings
+from ingest import chunk_hash
+from patient_facts import store_facts
 
 load_dotenv()
 SUPABASE_URL = os.environ["SUPABASE_URL"]
@@ -24,12 +26,22 @@ chunks = [
     }),
 ]
 
-texts = [c[0] for c in chunks]
-vecs  = emb.embed_documents(texts)  # 1536-d each
+# Re-running is a no-op: chunks whose content hash is already stored are
+# neither embedded nor written again
+hashes = [chunk_hash(md, text) for text, md in chunks]
+stored = {r["content_hash"] for r in (sb.table("rag_chunks").select("content_hash")
+                                      .in_("content_hash", hashes).execute().data or [])}
+todo = [(c, h) for c, h in zip(chunks, hashes) if h not in stored]
+
+texts = [c[0] for c, _ in todo]
+vecs  = emb.embed_documents(texts) if texts else []  # 1536-d each
 
 rows = []
-for (text, md), v in zip(chunks, vecs):
-    rows.append({"content": text, "metadata": md, "embedding": v})
+for ((text, md), h), v in zip(todo, vecs):
+    rows.append({"content": text, "metadata": md, "embedding": v, "content_hash": h})
 
-resp = sb.table("rag_chunks").insert(rows).execute()
-print("Inserted:", len(resp.data or []))
+resp = (sb.table("rag_chunks").upsert(rows, on_conflict="content_hash", ignore_duplicates=True)
+        .select("id", "content", "metadata").execute()) if rows else None
+print("Inserted:", len(resp.data or []) if resp else 0, "| unchanged:", len(stored))
+# Typed vitals/labs/medications for structured comparison queries
+print("Facts:", store_facts(sb, resp.data or []) if resp else 0)
@@ -0,0 +1,182 @@
+import os
+import atexit
+import random
+import asyncio
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+import httpx
+import openai
+from dotenv import load_dotenv
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+load_dotenv()
+
+# Shared HTTP connection pool to the OpenAI endpoint
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+OPENAI_POOL_IDLE_TIMEOUT = float(os.getenv("OPENAI_POOL_IDLE_TIMEOUT", "60"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "600"))
+
+# Retries on rate limits / transient errors in acall_with_backoff; clients
+# used with it are built with max_retries=0 so attempts don't multiply
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "6"))
+OPENAI_MAX_BACKOFF = float(os.getenv("OPENAI_MAX_BACKOFF", "60"))
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError,
+                    openai.APIConnectionError, openai.InternalServerError)
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_async_http_client: Optional["LoopLocalAsyncClient"] = None
+_registry: Dict[Tuple, Any] = {}
+
+
+def _http_client_options() -> Dict[str, Any]:
+    return dict(
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+        limits=httpx.Limits(
+            max_connections=OPENAI_POOL_SIZE,
+            max_keepalive_connections=OPENAI_POOL_SIZE,
+            keepalive_expiry=OPENAI_POOL_IDLE_TIMEOUT,
+        ),
+    )
+
+
+class LoopLocalAsyncClient(httpx.AsyncClient):
+    """
+    httpx.AsyncClient that sends through a separate pool per event loop.
+    Pooled connections belong to the loop that opened them, while model
+    objects are built once per process and awaited from any loop.
+    """
+
+    def __init__(self, **options: Any):
+        super().__init__(**options)
+        self._options = options
+        self._pools_lock = threading.Lock()
+        self._pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = \
+            weakref.WeakKeyDictionary()
+
+    def _pool(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        pool = self._pools.get(loop)
+        if pool is None:
+            with self._pools_lock:
+                pool = self._pools.get(loop)
+                if pool is None:
+                    pool = self._pools[loop] = httpx.AsyncClient(**self._options)
+        return pool
+
+    async def send(self, request: httpx.Request, **kwargs: Any) -> httpx.Response:
+        return await self._pool().send(request, **kwargs)
+
+    async def aclose(self) -> None:
+        """Closes the running loop's pool; the next request reopens it."""
+        pool = self._pools.pop(asyncio.get_running_loop(), None)
+        if pool is not None:
+            await pool.aclose()
+
+
+def get_openai_http_client() -> httpx.Client:
+    """Process-wide keep-alive httpx client shared by every OpenAI model object."""
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = httpx.Client(**_http_client_options())
+    return _http_client
+
+
+def get_openai_async_http_client() -> httpx.AsyncClient:
+    """Process-wide async httpx client for ainvoke/astream calls, pooled per event loop."""
+    global _async_http_client
+    if _async_http_client is None:
+        with _lock:
+            if _async_http_client is None:
+                _async_http_client = LoopLocalAsyncClient(**_http_client_options())
+    return _async_http_client
+
+
+def _get_or_build(key: Tuple, factory: Callable[[], Any]) -> Any:
+    obj = _registry.get(key)
+    if obj is None:
+        with _lock:
+            obj = _registry.get(key)
+            if obj is None:
+                obj = _registry[key] = factory()
+    return obj
+
+
+def _retry_kwargs(max_retries: Optional[int]) -> Dict[str, int]:
+    # None keeps the SDK's default retries
+    return {} if max_retries is None else {"max_retries": max_retries}
+
+
+def get_chat_model(model: str, temperature: float = 0,
+                   max_retries: Optional[int] = None) -> ChatOpenAI:
+    """ChatOpenAI built once per (model, temperature, max_retries) for the whole process."""
+    http_client = get_openai_http_client()
+    http_async_client = get_openai_async_http_client()
+    return _get_or_build(
+        ("chat", model, temperature, max_retries),
+        lambda: ChatOpenAI(model=model, temperature=temperature,
+                           http_client=http_client,
+                           http_async_client=http_async_client,
+                           **_retry_kwargs(max_retries)))
+
+
+def get_embeddings(model: str, max_retries: Optional[int] = None) -> OpenAIEmbeddings:
+    """OpenAIEmbeddings built once per (model, max_retries) for the whole process."""
+    http_client = get_openai_http_client()
+    http_async_client = get_openai_async_http_client()
+    return _get_or_build(
+        ("embeddings", model, max_retries),
+        lambda: OpenAIEmbeddings(model=model,
+                                 http_client=http_client,
+                                 http_async_client=http_async_client,
+                                 **_retry_kwargs(max_retries)))
+
+
+def get_chain(name: str, factory: Callable[[], Any]) -> Any:
+    """Runnable chain built by `factory` on first use and reused afterwards."""
+    return _get_or_build(("chain", name), factory)
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retry `attempt`: the server's Retry-After if given, else jittered exponential."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), OPENAI_MAX_BACKOFF)
+    except ValueError:
+        pass
+    return min(OPENAI_MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+async def acall_with_backoff(call: Callable[[], Awaitable[T]],
+                             max_retries: int = OPENAI_MAX_RETRIES) -> T:
+    """Awaits call(), retrying rate-limited and transient OpenAI failures with backoff."""
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except RETRYABLE_ERRORS as e:
+            if attempt >= max_retries:
+                raise
+            await asyncio.sleep(retry_delay(e, attempt))
+            attempt += 1
+
+
+def close_llm_clients() -> None:
+    global _http_client, _async_http_client
+    with _lock:
+        if _http_client is not None:
+            _http_client.close()
+        _http_client = None
+        # The async pools are dropped, not awaited; their loops may already be gone
+        _async_http_client = None
+        _registry.clear()
+
+
+atexit.register(close_llm_clients)
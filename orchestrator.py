@@ -0,0 +1,69 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Dict, List, Optional, Tuple, TypeVar
+from query_analyzer import aanalyze_query, likely_patient
+from retrieve_supabase import amatch_patient_chunks
+
+T = TypeVar("T")
+
+
+class EventLoopWorker:
+    """
+    One long-lived asyncio event loop on a daemon thread. Async clients
+    (Supabase, OpenAI) are bound to the loop they were first used on, so all
+    async work in the process runs here and reuses their connection pools.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name="async-worker",
+                                        daemon=True)
+        self._thread.start()
+
+    def run(self, coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+        """Runs `coro` on the worker loop and blocks the caller until it finishes."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+
+_worker: Optional[EventLoopWorker] = None
+_worker_lock = threading.Lock()
+
+
+def get_worker() -> EventLoopWorker:
+    global _worker
+    if _worker is None:
+        with _worker_lock:
+            if _worker is None:
+                _worker = EventLoopWorker()
+    return _worker
+
+
+def run(coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+    """Runs a coroutine on the process-wide event loop from synchronous code."""
+    return get_worker().run(coro, timeout)
+
+
+async def aroute_and_prefetch(
+        query: str,
+        roster: List[Dict[str, str]],
+        locked_patient: Optional[Dict[str, str]] = None,
+        k: int = 6) -> Tuple[Dict[str, Any], Optional[List[Dict[str, Any]]]]:
+    """
+    Routes the query while speculatively retrieving chunks for the likely
+    patient. Returns (analysis, hits); hits is None unless routing resolved
+    the same patient the speculation was for.
+    """
+    guess = likely_patient(query, roster, locked_patient)
+    prefetch = asyncio.ensure_future(
+        amatch_patient_chunks(query, guess["patient_id"], k)) if guess else None
+
+    analysis = await aanalyze_query(query, roster, locked_patient)
+
+    if prefetch is None:
+        return analysis, None
+    if (analysis.get("resolved_patient") or {}).get("patient_id") != guess["patient_id"]:
+        # Routing disagreed with the guess - drop the speculative retrieval
+        prefetch.cancel()
+        return analysis, None
+    return analysis, await prefetch
@@ -0,0 +1,284 @@
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from patients import mget
+from supabase_client import get_async_supabase
+
+load_dotenv()
+# Answer comparison queries on extracted vitals/labs/medications from the
+# patient_facts table (sql/patient_facts.sql) instead of vector search
+STRUCTURED_FACTS = os.getenv("STRUCTURED_FACTS", "1") not in ("0", "false", "False")
+# Values returned per patient and attribute (most recent first)
+FACTS_PER_ATTRIBUTE = int(os.getenv("FACTS_PER_ATTRIBUTE", "5"))
+FACTS_WRITE_BATCH = 500
+
+NUM = r"(\d+(?:\.\d+)?)"
+# Label, then up to a few non-digit characters ("Height:", "BP was", "AMH =")
+LABEL_GAP = r"[^0-9\n]{0,20}?"
+DATE_PATTERN = re.compile(r"\b(\d{4})[-/](\d{2})[-/](\d{2})\b")
+
+# A unit counts only right after the number and not followed by a letter or
+# "/" ("162 in March" and "37 c/o headache" are not units)
+UNIT_END = r"(?![A-Za-z/])"
+
+# attribute -> (pattern, canonical unit, {unit: factor to canonical})
+MEASUREMENTS: Dict[str, Tuple[re.Pattern, str, Dict[str, float]]] = {
+    "height": (re.compile(rf"\bheight\b{LABEL_GAP}{NUM}(?:\s*(cm|m|in|inches){UNIT_END})?", re.I),
+               "cm", {"cm": 1, "m": 100, "in": 2.54, "inches": 2.54}),
+    "weight": (re.compile(rf"\bweight\b{LABEL_GAP}{NUM}(?:\s*(kg|kgs|lb|lbs|pounds){UNIT_END})?", re.I),
+               "kg", {"kg": 1, "kgs": 1, "lb": 0.4536, "lbs": 0.4536, "pounds": 0.4536}),
+    "bmi": (re.compile(rf"\b(?:bmi|body mass index)\b{LABEL_GAP}{NUM}", re.I),
+            "kg/m2", {}),
+    "temperature": (re.compile(rf"\btemp(?:erature)?\b{LABEL_GAP}{NUM}(?:\s*°?\s*(c|f){UNIT_END})?", re.I),
+                    "°C", {"c": 1}),
+    "amh": (re.compile(rf"\b(?:amh|anti-m[uü]llerian hormone)\b{LABEL_GAP}{NUM}(?:\s*(ng/ml|pmol/l){UNIT_END})?", re.I),
+            "ng/mL", {"ng/ml": 1, "pmol/l": 1 / 7.14}),
+    "fsh": (re.compile(rf"\bfsh\b{LABEL_GAP}{NUM}(?:\s*(miu/ml|iu/l){UNIT_END})?", re.I),
+            "mIU/mL", {"miu/ml": 1, "iu/l": 1}),
+    "e2": (re.compile(rf"\b(?:e2|o?estradiol)\b{LABEL_GAP}{NUM}(?:\s*(pg/ml|pmol/l){UNIT_END})?", re.I),
+           "pg/mL", {"pg/ml": 1, "pmol/l": 1 / 3.671}),
+}
+# "Height: 5 ft 4 in", "height 5'4\""
+HEIGHT_FEET_PATTERN = re.compile(
+    rf"\bheight\b{LABEL_GAP}{NUM}\s*(?:ft|feet|foot|'){UNIT_END}"
+    rf"(?:\s*{NUM}\s*(?:in|inches|inch|\"|''){UNIT_END})?", re.I)
+# Values outside these ranges (canonical units) are parse errors, not facts
+PLAUSIBLE: Dict[str, Tuple[float, float]] = {
+    "height": (100, 230), "weight": (25, 300), "bmi": (10, 80), "temperature": (30, 45),
+    "amh": (0, 30), "fsh": (0, 200), "e2": (0, 20000),
+    "bp_systolic": (50, 300), "bp_diastolic": (20, 200),
+}
+BP_PATTERN = re.compile(rf"\b(?:bp|blood pressure)\b{LABEL_GAP}(\d{{2,3}})\s*/\s*(\d{{2,3}})", re.I)
+# "Letrozole 2.5 mg", "Folic acid 5 mg", "Gonal-f 150 IU"
+MEDICATION_PATTERN = re.compile(
+    rf"\b([A-Z][A-Za-z-]+(?: [a-z][A-Za-z-]+)?) {NUM}\s*(mg|mcg|µg|g|IU|iu|units?|ml|mL)\b")
+# Capitalised words that precede a dose without naming a drug
+NOT_MEDICATIONS = set("""
+height weight bmi temperature temp amh fsh e2 estradiol bp
+dose doses dosage dosing total take takes taking took daily dly once twice then
+give given giving start started starting begin began increase increased decrease decreased
+reduce reduced continue continued stop stopped hold held resume resumed switch switched
+administer administered inject injected injection injections prescribe prescribed
+add added plus and or with without each every per morning evening night nightly bedtime
+max maximum min minimum approx approximately about around up over under
+day days week weeks month cycle cycles protocol plan regimen current currently previous
+patient she he her his was is on at of for to in new old usual oral iv sc im
+""".split())
+
+# Query keyword -> attributes it asks about
+QUERY_ATTRIBUTES: Dict[str, Tuple[re.Pattern, Tuple[str, ...]]] = {
+    "height": (re.compile(r"\bheight|\btall", re.I), ("height",)),
+    "weight": (re.compile(r"\bweight|\bweigh", re.I), ("weight",)),
+    "bmi": (re.compile(r"\bbmi\b|body mass", re.I), ("bmi",)),
+    "blood pressure": (re.compile(r"\bbp\b|blood pressure", re.I), ("bp_systolic", "bp_diastolic")),
+    "temperature": (re.compile(r"\btemp(?:erature)?\b", re.I), ("temperature",)),
+    "AMH": (re.compile(r"\bamh\b|m[uü]llerian", re.I), ("amh",)),
+    "FSH": (re.compile(r"\bfsh\b", re.I), ("fsh",)),
+    "E2": (re.compile(r"\be2\b|o?estradiol", re.I), ("e2",)),
+    "medications": (re.compile(r"\bmedication|\bmeds?\b|\bdrugs?\b|prescri", re.I), ("medication",)),
+}
+# Whole words naming a structured attribute ("taller", "weighs", "prescribed")
+ATTRIBUTE_WORDS = [re.compile(rf"\w*(?:{pattern.pattern})\w*", re.I)
+                   for pattern, _ in QUERY_ATTRIBUTES.values()]
+# Words that phrase a comparison without asking about anything else
+FILLER_WORDS = set("""
+a an the and or of for to in on with between than vs versus is are was were be has have had
+do does did what what's which who whose whom how their them they her his she he its it both
+each all these those patients patient compare comparison compared difference differ different
+same higher lower highest lowest more less most least bigger smaller larger greater shorter
+heavier lighter current latest last recent value values level levels reading readings result
+results show list give tell me please s number numbers
+""".split())
+
+
+def _observed_on(text: str, metadata: Dict[str, Any]) -> Optional[str]:
+    # Facts in a chunk are dated by the chunk's date metadata or first ISO date
+    for key in ("date", "Date", "observed_on", "visit_date"):
+        if metadata.get(key):
+            match = DATE_PATTERN.search(str(metadata[key]))
+            if match:
+                return "-".join(match.groups())
+    match = DATE_PATTERN.search(text)
+    return "-".join(match.groups()) if match else None
+
+
+def _to_canonical(attribute: str, value: float, raw_unit: str, factors: Dict[str, float]) -> float:
+    if attribute == "temperature":
+        # Unitless values above 50 can only be Fahrenheit
+        return (value - 32) * 5 / 9 if raw_unit == "f" or (not raw_unit and value > 50) else value
+    if attribute == "height" and not raw_unit and value < 3:
+        return value * 100  # metres
+    return value * factors.get(raw_unit, 1)
+
+
+def extract_facts(text: str, metadata: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    Parses vitals, labs and medications out of one chunk. Returns rows of
+    {attribute, ordinal, value_num, value_text, unit, observed_on} with values
+    normalized to the attribute's canonical unit.
+    """
+    metadata = metadata or {}
+    observed_on = _observed_on(text, metadata)
+    facts: List[Dict[str, Any]] = []
+
+    def add(attribute: str, value_num: Optional[float], unit: str, value_text: str) -> None:
+        ordinal = sum(1 for f in facts if f["attribute"] == attribute)
+        facts.append({"attribute": attribute, "ordinal": ordinal,
+                      "value_num": None if value_num is None else round(value_num, 3),
+                      "value_text": value_text, "unit": unit, "observed_on": observed_on})
+
+    def add_measurement(attribute: str, value: Optional[float], unit: str, value_text: str) -> None:
+        low, high = PLAUSIBLE[attribute]
+        if value is not None and low <= value <= high:
+            add(attribute, value, unit, value_text)
+
+    feet_spans = []
+    for match in HEIGHT_FEET_PATTERN.finditer(text):
+        feet_spans.append(match.span())
+        inches = float(match.group(1)) * 12 + float(match.group(2) or 0)
+        add_measurement("height", inches * 2.54, "cm", match.group(0).strip())
+
+    for attribute, (pattern, unit, factors) in MEASUREMENTS.items():
+        for match in pattern.finditer(text):
+            if attribute == "height" and any(a <= match.start() < b for a, b in feet_spans):
+                continue
+            value = float(match.group(1))
+            raw_unit = (match.group(2) or "").lower() if pattern.groups > 1 else ""
+            # An explicit unit wins; if it gives an implausible value the
+            # number is read as unitless instead
+            candidates = [_to_canonical(attribute, value, raw_unit, factors)] if raw_unit else []
+            candidates.append(_to_canonical(attribute, value, "", factors))
+            low, high = PLAUSIBLE[attribute]
+            value = next((v for v in candidates if low <= v <= high), None)
+            add_measurement(attribute, value, unit, match.group(0).strip())
+
+    for match in BP_PATTERN.finditer(text):
+        systolic, diastolic = float(match.group(1)), float(match.group(2))
+        if (PLAUSIBLE["bp_systolic"][0] <= systolic <= PLAUSIBLE["bp_systolic"][1]
+                and PLAUSIBLE["bp_diastolic"][0] <= diastolic <= PLAUSIBLE["bp_diastolic"][1]):
+            add("bp_systolic", systolic, "mmHg", match.group(0).strip())
+            add("bp_diastolic", diastolic, "mmHg", match.group(0).strip())
+
+    for match in MEDICATION_PATTERN.finditer(text):
+        words = match.group(1).split()
+        # "Take letrozole 2.5 mg": skip the leading verb, keep the drug
+        while words and words[0].lower() in NOT_MEDICATIONS:
+            words = words[1:]
+        if not words or words[-1].lower() in NOT_MEDICATIONS:
+            continue
+        name = " ".join(words)
+        add("medication", float(match.group(2)), match.group(3), name[0].upper() + name[1:])
+
+    return facts
+
+
+def fact_rows(chunks: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """patient_facts rows for rag_chunks rows ({id, content, metadata})."""
+    rows = []
+    for chunk in chunks:
+        md = chunk.get("metadata") or {}
+        pid = mget(md, "patient_id")
+        if not pid:
+            continue
+        for fact in extract_facts(chunk.get("content") or "", md):
+            rows.append({"patient_id": pid, "chunk_id": chunk["id"], **fact})
+    return rows
+
+
+def store_facts(sb, chunks: Iterable[Dict[str, Any]]) -> int:
+    """
+    Re-derives the facts of the given chunks: their old rows are deleted and
+    the freshly extracted ones written. Needs a client that can write.
+    """
+    chunks = list(chunks)
+    rows = fact_rows(chunks)
+    ids = [c["id"] for c in chunks]
+    for i in range(0, len(ids), FACTS_WRITE_BATCH):
+        sb.table("patient_facts").delete().in_("chunk_id", ids[i:i + FACTS_WRITE_BATCH]).execute()
+    for i in range(0, len(rows), FACTS_WRITE_BATCH):
+        sb.table("patient_facts").upsert(
+            rows[i:i + FACTS_WRITE_BATCH], on_conflict="chunk_id,attribute,ordinal").execute()
+    return len(rows)
+
+
+async def astore_facts(sb, chunks: Iterable[Dict[str, Any]]) -> int:
+    """store_facts on an async client."""
+    chunks = list(chunks)
+    rows = fact_rows(chunks)
+    ids = [c["id"] for c in chunks]
+    for i in range(0, len(ids), FACTS_WRITE_BATCH):
+        await sb.table("patient_facts").delete().in_("chunk_id", ids[i:i + FACTS_WRITE_BATCH]).execute()
+    for i in range(0, len(rows), FACTS_WRITE_BATCH):
+        await sb.table("patient_facts").upsert(
+            rows[i:i + FACTS_WRITE_BATCH], on_conflict="chunk_id,attribute,ordinal").execute()
+    return len(rows)
+
+
+def backfill_facts(sb, page_size: int = 500) -> int:
+    """Extracts facts for every existing chunk (keyset pagination on id)."""
+    total = 0
+    after = None
+    while True:
+        q = sb.table("rag_chunks").select("id, content, metadata").order("id").limit(page_size)
+        if after is not None:
+            q = q.gt("id", after)
+        page = q.execute().data or []
+        if not page:
+            return total
+        total += store_facts(sb, page)
+        after = page[-1]["id"]
+
+
+def requested_attributes(prompt: str) -> Dict[str, Tuple[str, ...]]:
+    """{label: attributes} for every structured attribute the prompt asks about."""
+    return {label: attrs for label, (pattern, attrs) in QUERY_ATTRIBUTES.items()
+            if pattern.search(prompt)}
+
+
+def structured_only(prompt: str, names: Iterable[str] = ()) -> bool:
+    """
+    True if the prompt asks only about structured attributes ("who is taller,
+    Priya or Meera?"), False if it also asks about something else ("compare
+    their AMH and treatment plans").
+    """
+    text = prompt.lower()
+    for pattern in ATTRIBUTE_WORDS:
+        text = pattern.sub(" ", text)
+    name_words = {w for name in names for w in name.lower().split()}
+    words = re.findall(r"[a-z][a-z']*", text)
+    return not [w for w in words if w not in name_words and w not in FILLER_WORDS]
+
+
+async def afetch_facts(patient_ids: List[str], attributes: List[str],
+                       per_attribute: int = FACTS_PER_ATTRIBUTE) -> Dict[str, List[Dict[str, Any]]]:
+    """{patient_id: fact rows} for the requested attributes, newest first, in one RPC."""
+    sb = await get_async_supabase()
+    res = await sb.rpc("patient_facts_for", {
+        "p_patient_ids": patient_ids,
+        "p_attributes": attributes,
+        "per_attribute": per_attribute,
+    }).execute()
+    by_pid: Dict[str, List[Dict[str, Any]]] = {}
+    for row in res.data or []:
+        by_pid.setdefault(row["patient_id"], []).append(row)
+    return by_pid
+
+
+def format_facts(name: str, rows: List[Dict[str, Any]]) -> str:
+    """One compact context block with a patient's structured values."""
+    lines = [f"[{name}]: Structured record (most recent first)"]
+    for row in rows:
+        if row["attribute"] == "medication":
+            value = f"{row['value_text']} {row['value_num']:g} {row['unit']}"
+        else:
+            value = f"{row['value_num']:g} {row['unit']}"
+        when = f" ({row['observed_on']})" if row.get("observed_on") else ""
+        lines.append(f"- {row['attribute']}: {value}{when}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from supabase import create_client
+    sb = create_client(os.environ["SUPABASE_URL"], os.environ["SERVICE_SUPABASESERVICE_KEY"])
+    print("Facts written:", backfill_facts(sb))
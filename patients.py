@@ -1,6 +1,19 @@
-from typing import Dict, Any, List, Tuple, Optional
+import os
+import time
+import threading
+from typing import Dict, Any, List, Tuple, Optional, Iterator, AsyncIterator
+import numpy as np
 from rapidfuzz import process, fuzz
-from supabase_client import get_supabase
+from supabase_client import get_supabase, get_async_supabase
+
+# Where the roster is read from: the server-side "patients" table
+# (sql/patients.sql) or, without that migration, the metadata of every chunk
+ROSTER_SOURCE = os.getenv("ROSTER_SOURCE", "patients")
+
+# Roster cache: how often to look for new patients, and how often to rebuild fully
+ROSTER_TTL = float(os.getenv("ROSTER_TTL_SECONDS", "60"))
+ROSTER_FULL_REFRESH = float(os.getenv("ROSTER_FULL_REFRESH_SECONDS", "3600"))
+ROSTER_PAGE_SIZE = 1000
 
 ALIASES = {
     "patient_id": ["patient_id", "Patient_Id", "PatientID"],
@@ -17,24 +30,169 @@ def mget(md: Dict[str, Any], key: str) -> str:
     return ""
 
 
-def build_roster_from_supabase(limit: int = 20000) -> List[Dict[str, str]]:
+def _add_to_roster(by_pid: Dict[str, Dict[str, str]], md: Dict[str, Any]) -> bool:
+    pid = mget(md, "patient_id")
+    if not pid or pid in by_pid: return False
+    by_pid[pid] = {
+        "patient_id": pid,
+        "first_name": mget(md, "first_name"),
+        "last_name": mget(md, "last_name"),
+        "dob": mget(md, "dob")
+    }
+    return True
+
+
+def _apply_patient_row(by_pid: Dict[str, Dict[str, str]], row: Dict[str, Any]) -> bool:
+    """Applies one patients-table row (newest seq wins; deleted rows remove the patient)."""
+    pid = row["patient_id"]
+    if row.get("deleted"):
+        return by_pid.pop(pid, None) is not None
+    entry = {k: row.get(k) or "" for k in ("patient_id", "first_name", "last_name", "dob")}
+    if by_pid.get(pid) == entry:
+        return False
+    by_pid[pid] = entry
+    return True
+
+
+def _apply_row(by_pid: Dict[str, Dict[str, str]], md: Dict[str, Any]) -> bool:
+    if ROSTER_SOURCE == "rag_chunks":
+        return _add_to_roster(by_pid, md)
+    return _apply_patient_row(by_pid, md)
+
+
+def _roster_source() -> Tuple[str, str, str]:
+    """(table, keyset column, selected columns) for ROSTER_SOURCE."""
+    if ROSTER_SOURCE == "rag_chunks":
+        return "rag_chunks", "id", "id, metadata"
+    return "patients", "seq", "seq, patient_id, first_name, last_name, dob, deleted"
+
+
+def iter_roster_rows(after: Any = None,
+                     page_size: int = ROSTER_PAGE_SIZE) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+    """
+    Yields (key, metadata) for every roster source row with key > after,
+    in key order, using keyset pagination.
+    """
+    table, key, columns = _roster_source()
     sb = get_supabase()
-    res = sb.table("rag_chunks").select("metadata").limit(limit).execute()
+    while True:
+        q = sb.table(table).select(columns).order(key).limit(page_size)
+        if after is not None:
+            q = q.gt(key, after)
+        rows = q.execute().data or []
+        for row in rows:
+            md = row if table == "patients" else (row.get("metadata") or {})
+            yield row[key], md
+        if len(rows) < page_size:
+            break
+        after = rows[-1][key]
+
+
+def build_roster_from_supabase(limit: Optional[int] = None) -> List[Dict[str, str]]:
+    by_pid = {}
+    for _, md in iter_roster_rows():
+        _apply_row(by_pid, md)
+        if limit and len(by_pid) >= limit: break
+    return list(by_pid.values())
+
+
+async def aiter_roster_rows(after: Any = None,
+                            page_size: int = ROSTER_PAGE_SIZE) -> AsyncIterator[Tuple[Any, Dict[str, Any]]]:
+    """Async iter_roster_rows on the async Supabase client."""
+    table, key, columns = _roster_source()
+    sb = await get_async_supabase()
+    while True:
+        q = sb.table(table).select(columns).order(key).limit(page_size)
+        if after is not None:
+            q = q.gt(key, after)
+        rows = (await q.execute()).data or []
+        for row in rows:
+            md = row if table == "patients" else (row.get("metadata") or {})
+            yield row[key], md
+        if len(rows) < page_size:
+            break
+        after = rows[-1][key]
+
+
+async def abuild_roster(limit: Optional[int] = None) -> List[Dict[str, str]]:
     by_pid = {}
-    for row in (res.data or []):
-        md = row.get("metadata") or {}
-        pid = mget(md, "patient_id")
-        if not pid: continue
-        if pid not in by_pid:
-            by_pid[pid] = {
-                "patient_id": pid,
-                "first_name": mget(md, "first_name"),
-                "last_name": mget(md, "last_name"),
-                "dob": mget(md, "dob")
-            }
+    async for _, md in aiter_roster_rows():
+        _apply_row(by_pid, md)
+        if limit and len(by_pid) >= limit: break
     return list(by_pid.values())
 
 
+class RosterCache:
+    """
+    Process-wide roster shared by every Streamlit session and rerun.
+    After the TTL expires only rows added since the last seen key are
+    fetched (with the patients table that includes renamed and deleted
+    patients); a full rebuild runs every ROSTER_FULL_REFRESH seconds. `version` increments whenever the roster changes.
+    """
+
+    def __init__(self, ttl: float = ROSTER_TTL, full_refresh: float = ROSTER_FULL_REFRESH):
+        self.ttl = ttl
+        self.full_refresh = full_refresh
+        self.version = 0
+        self._by_pid: Dict[str, Dict[str, str]] = {}
+        self._roster: List[Dict[str, str]] = []
+        self._watermark: Any = None
+        self._checked_at: Optional[float] = None
+        self._full_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _stale(self, now: float) -> bool:
+        return self._checked_at is None or now - self._checked_at >= self.ttl
+
+    def get(self) -> List[Dict[str, str]]:
+        if self._stale(time.monotonic()):
+            with self._lock:
+                now = time.monotonic()
+                if self._stale(now):
+                    if self._full_at is None or now - self._full_at >= self.full_refresh:
+                        self._rebuild()
+                        self._full_at = now
+                    else:
+                        self._refresh()
+                    self._checked_at = now
+        return self._roster
+
+    def _rebuild(self) -> None:
+        by_pid: Dict[str, Dict[str, str]] = {}
+        watermark = None
+        for watermark, md in iter_roster_rows():
+            _apply_row(by_pid, md)
+        if by_pid != self._by_pid:
+            self._by_pid = by_pid
+            self._roster = list(by_pid.values())
+            self.version += 1
+        self._watermark = watermark
+
+    def _refresh(self) -> None:
+        by_pid = dict(self._by_pid)
+        changed = False
+        for key, md in iter_roster_rows(self._watermark):
+            changed = _apply_row(by_pid, md) or changed
+            self._watermark = key
+        if changed:
+            self._by_pid = by_pid
+            self._roster = list(by_pid.values())
+            self.version += 1
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._checked_at = None
+            self._full_at = None
+
+
+roster_cache = RosterCache()
+
+
+def get_roster() -> List[Dict[str, str]]:
+    """Cached roster; cheap to call on every Streamlit rerun."""
+    return roster_cache.get()
+
+
 # def fuzzy_resolve(roster: List[Dict[str,str]], q: str) -> Tuple[Optional[Dict[str,str]], List[Dict[str,str]], str]:
 #     q = (q or "").strip()
 #     if not q: return None, [], "none"
@@ -51,25 +209,161 @@ def build_roster_from_supabase(limit: int = 20000) -> List[Dict[str, str]]:
 #     return None, [], "none"
 
 
+ID_GRAM = 3
+
+
+def _grams(s: str, n: int) -> set:
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+class PatientIdIndex:
+    """
+    Patient ID lookups without scanning the roster: an exact (case-insensitive)
+    dict plus an n-gram posting index answering "which IDs contain q".
+    Grams of length 1..ID_GRAM are indexed, so short queries are answered
+    straight from one posting set; longer ones intersect their grams and
+    verify the few survivors.
+    """
+
+    def __init__(self, ids: List[str]):
+        self.ids_lower = [pid.lower() for pid in ids]
+        self.exact: Dict[str, int] = {}
+        self.postings: Dict[str, set] = {}
+        for i, pid in enumerate(self.ids_lower):
+            self.exact.setdefault(pid, i)
+            for n in range(1, ID_GRAM + 1):
+                for g in _grams(pid, n):
+                    self.postings.setdefault(g, set()).add(i)
+
+    def get(self, q: str) -> Optional[int]:
+        """Roster position of the ID equal to q (case-insensitive)."""
+        return self.exact.get(q.lower())
+
+    def find(self, q: str) -> List[int]:
+        """Roster positions of every ID containing q, in roster order."""
+        q = q.lower()
+        if len(q) <= ID_GRAM:
+            return sorted(self.postings.get(q, ()))
+        sets = []
+        for g in _grams(q, ID_GRAM):
+            posting = self.postings.get(g)
+            if not posting: return []
+            sets.append(posting)
+        sets.sort(key=len)
+        cands = sets[0].intersection(*sets[1:])
+        return sorted(i for i in cands if q in self.ids_lower[i])
+
+
+class RosterIndex:
+    """
+    Lookup structures for one roster snapshot: a PatientIdIndex and
+    pre-normalized full names ready for rapidfuzz.
+    Build once per roster version and reuse for every resolve.
+    """
+
+    def __init__(self, roster: List[Dict[str, str]], version: int = 0):
+        self.roster = roster
+        self.version = version
+        self.ids = PatientIdIndex([r["patient_id"] for r in roster])
+        self.names_lower = [
+            f"{r['first_name']} {r['last_name']}".strip().lower() for r in roster
+        ]
+        # Exact multi-word names and every individual name word, for scanning prompts
+        self.full_names: Dict[str, List[int]] = {}
+        for i, name in enumerate(self.names_lower):
+            if " " in name:
+                self.full_names.setdefault(" ".join(name.split()), []).append(i)
+        self.name_tokens = {t for name in self.names_lower for t in name.split()}
+
+    def resolve(self, q: str) -> Tuple[Optional[Dict[str, str]], List[Dict[str, str]], str]:
+        q = (q or "").strip()
+        if not q: return None, [], "none"
+        q_lower = q.lower()
+        id_hits = [self.roster[i] for i in self.ids.find(q_lower)]
+        if len(id_hits) == 1: return id_hits[0], [], "by_id"
+        if len(id_hits) > 1: return None, id_hits, "ambiguous"
+        if self.names_lower:
+            # One scoring pass: the top hit decides a match, the rest are candidates
+            hits = process.extract(q_lower,
+                                   self.names_lower,
+                                   scorer=fuzz.WRatio,
+                                   limit=5,
+                                   score_cutoff=60)
+            if hits and hits[0][1] >= 80: return self.roster[hits[0][2]], [], "by_name"
+            cands = [self.roster[idx] for name, score, idx in hits]
+            if cands: return None, cands, "ambiguous"
+        return None, [], "none"
+
+    def resolve_many(
+            self,
+            refs: List[str],
+            workers: int = -1) -> List[Tuple[Optional[Dict[str, str]], List[Dict[str, str]], str]]:
+        """
+        Same as resolve() for each ref, but all name lookups are scored in one
+        rapidfuzz cdist matrix (refs x roster names) across `workers` threads.
+        """
+        results: List[Any] = [None] * len(refs)
+        by_name: List[Tuple[int, str]] = []
+        for i, ref in enumerate(refs):
+            q = (ref or "").strip()
+            if not q:
+                results[i] = (None, [], "none")
+                continue
+            id_hits = [self.roster[j] for j in self.ids.find(q)]
+            if len(id_hits) == 1: results[i] = (id_hits[0], [], "by_id")
+            elif len(id_hits) > 1: results[i] = (None, id_hits, "ambiguous")
+            elif not self.names_lower: results[i] = (None, [], "none")
+            else: by_name.append((i, q.lower()))
+        if by_name:
+            scores = process.cdist([q for _, q in by_name],
+                                   self.names_lower,
+                                   scorer=fuzz.WRatio,
+                                   score_cutoff=60,
+                                   workers=workers)
+            for (i, _), row in zip(by_name, scores):
+                # Top 5 by score, ties broken by roster order (as process.extract)
+                kth = np.partition(row, -min(5, len(row)))[-min(5, len(row))]
+                top = np.flatnonzero(row >= max(kth, 60))
+                top = top[np.argsort(-row[top], kind="stable")][:5]
+                if len(top) and row[top[0]] >= 80:
+                    results[i] = (self.roster[top[0]], [], "by_name")
+                elif len(top):
+                    results[i] = (None, [self.roster[j] for j in top], "ambiguous")
+                else:
+                    results[i] = (None, [], "none")
+        return results
+
+
+_index: Optional[RosterIndex] = None
+_index_version = 0
+_index_lock = threading.Lock()
+
+
+def get_roster_index(roster: List[Dict[str, str]]) -> RosterIndex:
+    """
+    Index for `roster`, rebuilt only when a different roster list is passed
+    (RosterCache hands out a new list whenever its version changes).
+    Each rebuild gets a new `version`, usable as a cache key for the roster.
+    """
+    global _index, _index_version
+    index = _index
+    if index is None or index.roster is not roster:
+        with _index_lock:
+            _index_version += 1
+            index = RosterIndex(roster, _index_version)
+            _index = index
+    return index
+
+
 def fuzzy_resolve(
         roster: List[Dict[str, str]],
         q: str) -> Tuple[Optional[Dict[str, str]], List[Dict[str, str]], str]:
-    q = (q or "").strip()
-    if not q: return None, [], "none"
-    id_hits = [r for r in roster if q.lower() in r["patient_id"].lower()]
-    if len(id_hits) == 1: return id_hits[0], [], "by_id"
-    if len(id_hits) > 1: return None, id_hits, "ambiguous"
-    names = [f"{r['first_name']} {r['last_name']}".strip() for r in roster]
-    if names:
-        q_lower = q.lower()  # Normalize query to lowercase
-        names_lower = [name.lower()
-                       for name in names]  # Normalize all names to lowercase
-        best = process.extractOne(q_lower, names_lower, scorer=fuzz.WRatio)
-        if best and best[1] >= 80: return roster[best[2]], [], "by_name"
-        cands = process.extract(q_lower,
-                                names_lower,
-                                scorer=fuzz.WRatio,
-                                limit=5)
-        cands = [roster[idx] for name, score, idx in cands if score >= 60]
-        if cands: return None, cands, "ambiguous"
-    return None, [], "none"
+    return get_roster_index(roster).resolve(q)
+
+
+def fuzzy_resolve_many(
+        roster: List[Dict[str, str]],
+        refs: List[str],
+        workers: int = -1) -> List[Tuple[Optional[Dict[str, str]], List[Dict[str, str]], str]]:
+    """Resolves several references at once; one (resolved, candidates, reason) per ref."""
+    return get_roster_index(roster).resolve_many(refs, workers=workers)
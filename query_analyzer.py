@@ -1,14 +1,40 @@
-from typing import Optional, List, Dict, Any
-from langchain_openai import ChatOpenAI
+from typing import Optional, List, Dict, Any, Tuple
+from collections import OrderedDict
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from patients import fuzzy_resolve
+from patients import fuzzy_resolve, fuzzy_resolve_many, get_roster_index
+from llm_clients import get_chat_model, get_chain
 import os
 import re
+import copy
+import time
+import threading
 
 # Use an SLM (Small Language Model) for routing - faster and cheaper
 ROUTER_MODEL = os.getenv("ROUTER_MODEL", "gpt-3.5-turbo")
-router_llm = ChatOpenAI(model=ROUTER_MODEL, temperature=0)
+router_llm = get_chat_model(ROUTER_MODEL)
+
+# Route obvious prompts (roster IDs, full names, pronoun follow-ups) locally
+FAST_ROUTE = os.getenv("FAST_ROUTE", "1") not in ("0", "false", "False")
+WORD_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]*")
+COMPARISON_PATTERN = re.compile(
+    r"\b(compare|compared|comparison|versus|vs|between|both|difference|differ|all)\b",
+    re.IGNORECASE)
+# Only unambiguous singular references; "they"/"their" and "the patient" are
+# just as often generic ("how do they work?") and are left to the SLM
+PRONOUN_PATTERN = re.compile(
+    r"\b(he|she|him|his|her|hers|himself|herself|this patient)\b",
+    re.IGNORECASE)
+# Prompts that also read as general knowledge questions go to the SLM
+GENERAL_PATTERN = re.compile(
+    r"\b(in general|generally|typically|usually|guidelines?|protocols? for|define|definition"
+    r"|what (is|are) (a|an)|how do(es)? \w+(?: \w+)? work)\b",
+    re.IGNORECASE)
+MAX_NAME_WORDS = 4
+
+# Cache of raw SLM routing decisions for repeated prompts
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "2048"))
+ROUTING_CACHE_TTL = float(os.getenv("ROUTING_CACHE_TTL_SECONDS", "3600"))
 
 # Define the routing prompt
 ROUTING_PROMPT = ChatPromptTemplate.from_messages([(
@@ -43,6 +69,170 @@ IMPORTANT: When extracting patient_references, make sure to include ALL patients
 ), ("user", "{query}")])
 
 
+def normalize_query(query: str) -> str:
+    return " ".join((query or "").lower().split()).rstrip("?.!")
+
+
+class RoutingCache:
+    """Thread-safe LRU of SLM routing decisions with per-entry TTL."""
+
+    def __init__(self, max_items: int = ROUTING_CACHE_SIZE, ttl: float = ROUTING_CACHE_TTL):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items: "OrderedDict[Tuple, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(query: str,
+            locked_patient: Optional[Dict[str, str]],
+            roster_version: int) -> Tuple:
+        pid = locked_patient["patient_id"] if locked_patient else None
+        return normalize_query(query), pid, roster_version
+
+    def get(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return copy.deepcopy(entry[1])
+
+    def put(self, key: Tuple, decision: Dict[str, Any]) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic(), copy.deepcopy(decision))
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+routing_cache = RoutingCache()
+
+
+def scan_patient_mentions(
+        query: str,
+        roster: List[Dict[str, str]]) -> Tuple[List[Tuple[int, str, int]], List[str], bool]:
+    """
+    Scans the prompt for exact roster patient IDs and full names.
+    Returns (hits, leftover_names, ambiguous): hits are (word position,
+    reference text, roster position) in order of mention, leftover_names are
+    roster name words not part of a hit, and ambiguous is True when a full
+    name belongs to more than one patient.
+    """
+    index = get_roster_index(roster)
+    words = WORD_PATTERN.findall(query)
+    lowered = [w.lower() for w in words]
+
+    hits = []
+    used = set()
+    ambiguous = False
+    for pos, word in enumerate(words):
+        i = index.ids.get(word)
+        if i is not None:
+            hits.append((pos, word, i))
+            used.add(pos)
+    for pos in range(len(words)):
+        if pos in used: continue
+        for size in range(MAX_NAME_WORDS, 1, -1):
+            span = range(pos, pos + size)
+            if span[-1] >= len(words) or used.intersection(span): continue
+            matches = index.full_names.get(" ".join(lowered[pos:pos + size]))
+            if not matches: continue
+            if len(matches) > 1:
+                ambiguous = True  # Same full name, different patients
+                break
+            hits.append((pos, " ".join(words[pos:pos + size]), matches[0]))
+            used.update(span)
+            break
+
+    leftover = [words[pos] for pos, w in enumerate(lowered)
+                if pos not in used and w in index.name_tokens]
+    return sorted(hits), leftover, ambiguous
+
+
+def likely_patient(
+        query: str,
+        roster: List[Dict[str, str]],
+        locked_patient: Optional[Dict[str, str]] = None) -> Optional[Dict[str, str]]:
+    """
+    Cheap guess at the patient a prompt is about, for speculative retrieval
+    while the router runs: the one ID/full name mentioned, else a lone
+    name word that resolves to one patient, else the locked patient.
+    Returns None when several patients are mentioned.
+    """
+    hits, leftover, _ = scan_patient_mentions(query, roster)
+    if len({i for _, _, i in hits}) > 1:
+        return None
+    if hits:
+        return roster[hits[0][2]]
+    if leftover:
+        resolved, _, _ = fuzzy_resolve(roster, leftover[0])
+        if resolved:
+            return resolved
+    return locked_patient
+
+
+def fast_route(
+        query: str,
+        roster: List[Dict[str, str]],
+        locked_patient: Optional[Dict[str, str]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Deterministic pre-router. Scans the prompt for exact roster patient IDs
+    and full names, and for pronoun follow-ups when a patient is locked.
+    Returns the same dict as analyze_query_with_slm when the answer is
+    unambiguous, otherwise None so the SLM decides.
+    """
+    hits, leftover, ambiguous = scan_patient_mentions(query, roster)
+    # A leftover roster name word (e.g. a first name alone) needs the SLM
+    if ambiguous or leftover:
+        return None
+
+    patients = []
+    refs = []
+    for _, ref, i in hits:
+        if roster[i] not in patients:
+            patients.append(roster[i])
+            refs.append(ref)
+
+    result = {
+        "intent": "patient_specific",
+        "patient_reference": refs[0] if refs else None,
+        "patient_references": [],
+        "confidence": 1.0,
+        "resolved_patient": None,
+        "resolved_patients": [],
+        "candidates": []
+    }
+    if len(patients) >= 2:
+        result["intent"] = "multi_patient"
+        result["patient_references"] = refs
+        result["resolved_patients"] = patients
+        return result
+    if COMPARISON_PATTERN.search(query):
+        return None
+    if len(patients) == 1:
+        result["resolved_patient"] = patients[0]
+        return result
+    if locked_patient and PRONOUN_PATTERN.search(query) and not GENERAL_PATTERN.search(query):
+        result["intent"] = "patient_specific_use_locked"
+        result["resolved_patient"] = locked_patient
+        return result
+    return None
+
+
+SLM_FALLBACK_DECISION = {
+    "intent": "general",
+    "patient_reference": None,
+    "confidence": 0.5
+}
+
+
+def get_router_chain():
+    return get_chain("router", lambda: ROUTING_PROMPT | router_llm | JsonOutputParser())
+
+
 def analyze_query_with_slm(
         query: str,
         roster: List[Dict[str, str]],
@@ -58,19 +248,55 @@ def analyze_query_with_slm(
     Returns:
         Dict with: intent, patient_reference, resolved_patient, candidates, confidence
     """
-    # Get SLM routing decision
-    chain = ROUTING_PROMPT | router_llm | JsonOutputParser()
-
-    try:
-        routing_decision = chain.invoke({"query": query})
-    except Exception as e:
-        # Fallback to general if SLM fails
-        routing_decision = {
-            "intent": "general",
-            "patient_reference": None,
-            "confidence": 0.5
-        }
+    if FAST_ROUTE:
+        fast = fast_route(query, roster, locked_patient)
+        if fast:
+            return fast
 
+    # Get SLM routing decision (reused for repeated prompts)
+    cache_key = RoutingCache.key(query, locked_patient,
+                                 get_roster_index(roster).version)
+    routing_decision = routing_cache.get(cache_key)
+    if routing_decision is None:
+        try:
+            routing_decision = get_router_chain().invoke({"query": query})
+            routing_cache.put(cache_key, routing_decision)
+        except Exception as e:
+            # Fallback to general if SLM fails
+            routing_decision = dict(SLM_FALLBACK_DECISION)
+
+    return resolve_routing_decision(routing_decision, query, roster, locked_patient)
+
+
+async def aanalyze_query(
+        query: str,
+        roster: List[Dict[str, str]],
+        locked_patient: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Async analyze_query_with_slm; the router call does not block the event loop."""
+    if FAST_ROUTE:
+        fast = fast_route(query, roster, locked_patient)
+        if fast:
+            return fast
+
+    cache_key = RoutingCache.key(query, locked_patient,
+                                 get_roster_index(roster).version)
+    routing_decision = routing_cache.get(cache_key)
+    if routing_decision is None:
+        try:
+            routing_decision = await get_router_chain().ainvoke({"query": query})
+            routing_cache.put(cache_key, routing_decision)
+        except Exception as e:
+            routing_decision = dict(SLM_FALLBACK_DECISION)
+
+    return resolve_routing_decision(routing_decision, query, roster, locked_patient)
+
+
+def resolve_routing_decision(
+        routing_decision: Dict[str, Any],
+        query: str,
+        roster: List[Dict[str, str]],
+        locked_patient: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Turns a raw SLM routing decision into the analysis dict, resolving patients against the roster."""
     result = {
         "intent": routing_decision.get("intent", "general"),
         "patient_reference": routing_decision.get("patient_reference"),
@@ -116,9 +342,10 @@ def analyze_query_with_slm(
         if len(patient_refs) >= 2:
             resolved_patients = []
             unresolved_refs = []
-            for ref in patient_refs:
+            # Resolve all references in one vectorized scoring pass
+            resolutions = fuzzy_resolve_many(roster, patient_refs)
+            for ref, (resolved, candidates, reason) in zip(patient_refs, resolutions):
                 if ref:  # Only process non-empty references
-                    resolved, candidates, reason = fuzzy_resolve(roster, ref)
                     if resolved:
                         # Check if we already have this patient (avoid duplicates)
                         if not any(p['patient_id'] == resolved['patient_id'] for p in resolved_patients):
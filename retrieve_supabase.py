@@ -1,12 +1,24 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings
-from supabase_client import get_supabase
+from supabase_client import get_supabase, get_async_supabase
+from embedding_cache import CachedEmbeddings
+from llm_clients import get_embeddings
 
 load_dotenv()
 EMBED_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
-emb = OpenAIEmbeddings(model=EMBED_MODEL)
+# Embeddings are cached per (model, text) in memory and on disk
+emb = CachedEmbeddings(get_embeddings(EMBED_MODEL), EMBED_MODEL)
+
+# Batched retrieval is one RPC by default. Setting RETRIEVAL_PATIENTS_PER_RPC
+# shards it by patient and runs the shards concurrently, so the database
+# serves each shard on its own connection (0 = no sharding)
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "8"))
+RETRIEVAL_PATIENTS_PER_RPC = int(os.getenv("RETRIEVAL_PATIENTS_PER_RPC", "0"))
+rpc_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS,
+                                  thread_name_prefix="retrieval-rpc")
 
 
 def match_patient_chunks(query: str,
@@ -27,6 +39,20 @@ def match_patient_chunks(query: str,
     return res.data or []
 
 
+async def amatch_patient_chunks(query: str,
+                                patient_id: str,
+                                k: int = 6) -> List[Dict[str, Any]]:
+    """Async match_patient_chunks on the async Supabase/OpenAI clients."""
+    qvec = await emb.aembed_query(query)
+    sb = await get_async_supabase()
+    res = await sb.rpc("match_patient_chunks_arr", {
+        "query_embedding": qvec,
+        "match_count": k,
+        "p_patient_id": patient_id
+    }).execute()
+    return res.data or []
+
+
 def match_general_documents(query: str, k: int = 6) -> List[Dict[str, Any]]:
     """
     Calls SQL function for general documents (not patient-specific):
@@ -40,3 +66,110 @@ def match_general_documents(query: str, k: int = 6) -> List[Dict[str, Any]]:
         "match_count": k
     }).execute()
     return res.data or []
+
+
+async def amatch_general_documents(query: str, k: int = 6) -> List[Dict[str, Any]]:
+    """Async match_general_documents on the async Supabase/OpenAI clients."""
+    qvec = await emb.aembed_query(query)
+    sb = await get_async_supabase()
+    res = await sb.rpc("match_general_docs_arr", {
+        "query_embedding": qvec,
+        "match_count": k
+    }).execute()
+    return res.data or []
+
+
+def _shard_requests(requests: List[Tuple[str, str, int]]) -> List[List[int]]:
+    """Groups request positions into shards of RETRIEVAL_PATIENTS_PER_RPC patients (0: one shard)."""
+    if RETRIEVAL_PATIENTS_PER_RPC <= 0:
+        return [list(range(len(requests)))]
+    pids = list(dict.fromkeys(pid for _, pid, _ in requests))
+    per_rpc = RETRIEVAL_PATIENTS_PER_RPC
+    shards = []
+    for n in range(0, len(pids), per_rpc):
+        shard_pids = set(pids[n:n + per_rpc])
+        shards.append([i for i, (_, pid, _) in enumerate(requests) if pid in shard_pids])
+    return shards
+
+
+def _shard_payload(requests: List[Tuple[str, str, int]],
+                   req_ids: List[int],
+                   qvecs: Dict[str, List[float]]) -> Dict[str, Any]:
+    queries = list(dict.fromkeys(requests[i][0] for i in req_ids))
+    q_index = {q: n for n, q in enumerate(queries)}
+    return {
+        "query_embeddings": [qvecs[q] for q in queries],
+        "requests": [{"q": q_index[requests[i][0]], "patient_id": requests[i][1], "k": requests[i][2]}
+                     for i in req_ids]
+    }
+
+
+def _group_hits(requests: List[Tuple[str, str, int]],
+                rows: List[Tuple[int, Dict[str, Any]]]) -> Dict[str, List[List[Dict[str, Any]]]]:
+    by_req: List[List[Dict[str, Any]]] = [[] for _ in requests]
+    for req_id, hit in rows:
+        by_req[req_id].append(hit)
+
+    grouped: Dict[str, List[List[Dict[str, Any]]]] = {}
+    for (_, pid, _), hits in zip(requests, by_req):
+        grouped.setdefault(pid, []).append(hits)
+    return grouped
+
+
+def _match_patient_chunks_shard(
+        requests: List[Tuple[str, str, int]],
+        req_ids: List[int],
+        qvecs: Dict[str, List[float]]) -> List[Tuple[int, Dict[str, Any]]]:
+    """One match_patient_chunks_batch RPC for a subset of requests; returns (request id, hit)."""
+    sb = get_supabase()
+    res = sb.rpc("match_patient_chunks_batch",
+                 _shard_payload(requests, req_ids, qvecs)).execute()
+    return [(req_ids[row["req_idx"]], row["hit"]) for row in (res.data or [])]
+
+
+def match_patient_chunks_batch(
+        requests: List[Tuple[str, str, int]]) -> Dict[str, List[List[Dict[str, Any]]]]:
+    """
+    Resolves many (query, patient_id, k) requests via:
+      match_patient_chunks_batch(query_embeddings jsonb, requests jsonb)
+    Distinct query strings are embedded together in one batch call, and all
+    requests go in a single round trip. With RETRIEVAL_PATIENTS_PER_RPC set,
+    they are split into shards of that many patients, issued concurrently on
+    rpc_executor, so wall time tracks the slowest shard.
+    Returns {patient_id: [hits for each of that patient's requests, in order]}
+    where hits are rows: {id, content, metadata, similarity}
+    """
+    if not requests:
+        return {}
+    queries = list(dict.fromkeys(q for q, _, _ in requests))
+    qvecs = dict(zip(queries, emb.embed_documents(queries)))
+
+    shards = _shard_requests(requests)
+    if len(shards) == 1:
+        rows = _match_patient_chunks_shard(requests, shards[0], qvecs)
+    else:
+        futures = [rpc_executor.submit(_match_patient_chunks_shard, requests, ids, qvecs)
+                   for ids in shards]
+        rows = [row for f in futures for row in f.result()]
+    return _group_hits(requests, rows)
+
+
+async def amatch_patient_chunks_batch(
+        requests: List[Tuple[str, str, int]]) -> Dict[str, List[List[Dict[str, Any]]]]:
+    """Async match_patient_chunks_batch; shards are awaited concurrently."""
+    if not requests:
+        return {}
+    queries = list(dict.fromkeys(q for q, _, _ in requests))
+    qvecs = dict(zip(queries, await emb.aembed_documents(queries)))
+    sb = await get_async_supabase()
+    # At most RETRIEVAL_WORKERS shards in flight, as with the sync thread pool
+    limit = asyncio.Semaphore(RETRIEVAL_WORKERS)
+
+    async def run_shard(req_ids: List[int]) -> List[Tuple[int, Dict[str, Any]]]:
+        async with limit:
+            res = await sb.rpc("match_patient_chunks_batch",
+                               _shard_payload(requests, req_ids, qvecs)).execute()
+        return [(req_ids[row["req_idx"]], row["hit"]) for row in (res.data or [])]
+
+    results = await asyncio.gather(*(run_shard(ids) for ids in _shard_requests(requests)))
+    return _group_hits(requests, [row for shard in results for row in shard])
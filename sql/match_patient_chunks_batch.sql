@@ -0,0 +1,27 @@
+-- Batched patient retrieval: resolves many (query embedding, patient_id, k)
+-- requests in a single round trip by fanning out over match_patient_chunks_arr.
+--
+--   query_embeddings: JSON array of embeddings, each a JSON array of floats
+--   requests:         JSON array of {"q": <index into query_embeddings>,
+--                                    "patient_id": <text>, "k": <int>}
+--
+-- Returns one row per hit, tagged with the index of the request it answers.
+create or replace function match_patient_chunks_batch(
+  query_embeddings jsonb,
+  requests jsonb
+)
+returns table (req_idx int, patient_id text, hit jsonb)
+language sql stable
+as $$
+  select
+    (r.ord - 1)::int as req_idx,
+    r.item->>'patient_id' as patient_id,
+    to_jsonb(m) as hit
+  from jsonb_array_elements(requests) with ordinality as r(item, ord)
+  cross join lateral match_patient_chunks_arr(
+    (query_embeddings -> ((r.item->>'q')::int))::text::vector,
+    (r.item->>'k')::int,
+    r.item->>'patient_id'
+  ) as m
+  order by r.ord, m.similarity desc;
+$$;
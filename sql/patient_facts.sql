@@ -0,0 +1,66 @@
+-- Typed facts extracted from rag_chunks.content at ingestion time
+-- (patient_facts.py): vitals, labs (AMH/FSH/E2) and medications, one row per
+-- value, keyed by patient. Comparison queries on these attributes read this
+-- table instead of running vector searches.
+--
+-- chunk_id must match the type of rag_chunks.id (bigint here).
+create table if not exists patient_facts (
+  id          bigint generated always as identity primary key,
+  patient_id  text not null,
+  chunk_id    bigint not null references rag_chunks(id) on delete cascade,
+  attribute   text not null,    -- height, weight, bmi, bp_systolic, bp_diastolic,
+                                -- temperature, amh, fsh, e2, medication
+  ordinal     int not null default 0,  -- nth value of this attribute in the chunk
+  value_num   double precision,        -- normalized to `unit`
+  value_text  text,                    -- medication name / raw text
+  unit        text,
+  observed_on date,
+  unique (chunk_id, attribute, ordinal)
+);
+
+create index if not exists patient_facts_lookup
+  on patient_facts (attribute, patient_id, observed_on desc nulls last);
+
+-- Most recent `per_attribute` values of each requested attribute for each
+-- patient, in one indexed query.
+create or replace function patient_facts_for(
+  p_patient_ids text[],
+  p_attributes text[],
+  per_attribute int default 5
+)
+returns table (patient_id text, attribute text, value_num double precision,
+               value_text text, unit text, observed_on date, chunk_id bigint)
+language sql stable
+as $$
+  select f.patient_id, f.attribute, f.value_num, f.value_text, f.unit,
+         f.observed_on, f.chunk_id
+  from (
+    select pf.*,
+           row_number() over (
+             partition by pf.patient_id, pf.attribute
+             order by pf.observed_on desc nulls last, pf.chunk_id desc, pf.ordinal
+           ) as rn
+    from patient_facts pf
+    where pf.patient_id = any(p_patient_ids)
+      and pf.attribute = any(p_attributes)
+  ) f
+  where f.rn <= per_attribute
+  order by f.patient_id, f.attribute, f.rn;
+$$;
+
+-- Latest value of each requested attribute for every patient (every distinct
+-- medication for "medication"), for cohort aggregates computed by cohort.py.
+create or replace function cohort_facts(p_attributes text[])
+returns table (patient_id text, attribute text, value_num double precision,
+               value_text text, unit text, observed_on date)
+language sql stable
+as $$
+  select distinct on (pf.patient_id, pf.attribute,
+                      case when pf.attribute = 'medication' then lower(pf.value_text) else '' end)
+         pf.patient_id, pf.attribute, pf.value_num, pf.value_text, pf.unit, pf.observed_on
+  from patient_facts pf
+  where pf.attribute = any(p_attributes)
+  order by pf.patient_id, pf.attribute,
+           case when pf.attribute = 'medication' then lower(pf.value_text) else '' end,
+           pf.observed_on desc nulls last, pf.chunk_id desc, pf.ordinal;
+$$;
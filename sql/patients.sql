@@ -0,0 +1,129 @@
+-- Distinct-patient projection of rag_chunks.metadata, maintained by trigger.
+-- The app reads its roster from here (one row per patient) with keyset
+-- pagination on seq instead of scanning the metadata of every chunk.
+--
+-- The most recently written chunk supplies the name and DOB (empty values
+-- keep the previous ones). Every change, including a patient losing their
+-- last chunk (deleted = true), gets a new seq, so the app's incremental
+-- refresh picks up renames and removals as well as new patients.
+create table if not exists patients (
+  patient_id text primary key,
+  first_name text not null default '',
+  last_name  text not null default '',
+  dob        text not null default '',
+  deleted    boolean not null default false,
+  seq        bigint generated by default as identity unique
+);
+
+-- Upgrade tables created by the earlier version of this script
+alter table patients add column if not exists deleted boolean not null default false;
+alter table patients alter column seq set generated by default;
+
+create or replace function chunk_patient_id(metadata jsonb)
+returns text
+language sql immutable
+as $$
+  select nullif(coalesce(metadata->>'patient_id', metadata->>'Patient_Id',
+                         metadata->>'PatientID'), '');
+$$;
+
+-- Lets the delete trigger check cheaply whether a patient has chunks left
+create index if not exists rag_chunks_patient_id on rag_chunks (chunk_patient_id(metadata));
+
+create or replace function patients_upsert(md jsonb)
+returns void
+language plpgsql
+as $$
+declare
+  pid text := chunk_patient_id(md);
+begin
+  if pid is null then
+    return;
+  end if;
+  insert into patients (patient_id, first_name, last_name, dob)
+  values (
+    pid,
+    coalesce(md->>'first_name', md->>'First_Name', ''),
+    coalesce(md->>'last_name', md->>'Last_Name', ''),
+    coalesce(md->>'dob', md->>'Date_of_birth', md->>'DOB', '')
+  )
+  on conflict (patient_id) do update set
+    first_name = coalesce(nullif(excluded.first_name, ''), patients.first_name),
+    last_name  = coalesce(nullif(excluded.last_name, ''), patients.last_name),
+    dob        = coalesce(nullif(excluded.dob, ''), patients.dob),
+    deleted    = false,
+    seq        = nextval(pg_get_serial_sequence('patients', 'seq'))
+  where (patients.first_name, patients.last_name, patients.dob, patients.deleted)
+        is distinct from (coalesce(nullif(excluded.first_name, ''), patients.first_name),
+                          coalesce(nullif(excluded.last_name, ''), patients.last_name),
+                          coalesce(nullif(excluded.dob, ''), patients.dob),
+                          false);
+end;
+$$;
+
+-- Marks a patient deleted once no chunk refers to them any more
+create or replace function patients_tombstone(pid text)
+returns void
+language plpgsql
+as $$
+begin
+  if pid is null
+     or exists (select 1 from rag_chunks where chunk_patient_id(metadata) = pid) then
+    return;
+  end if;
+  update patients
+  set deleted = true,
+      seq = nextval(pg_get_serial_sequence('patients', 'seq'))
+  where patient_id = pid and not deleted;
+end;
+$$;
+
+create or replace function rag_chunks_upsert_patient()
+returns trigger
+language plpgsql
+as $$
+begin
+  if tg_op in ('UPDATE', 'DELETE') then
+    perform patients_tombstone(chunk_patient_id(old.metadata));
+  end if;
+  if tg_op in ('INSERT', 'UPDATE') then
+    perform patients_upsert(new.metadata);
+    return new;
+  end if;
+  return old;
+end;
+$$;
+
+drop trigger if exists rag_chunks_patients on rag_chunks;
+create trigger rag_chunks_patients
+  after insert or update of metadata or delete on rag_chunks
+  for each row execute function rag_chunks_upsert_patient();
+
+-- Backfill from existing chunks (newest chunk per patient wins) and mark
+-- patients without chunks deleted
+insert into patients (patient_id, first_name, last_name, dob)
+select distinct on (pid)
+  pid,
+  coalesce(metadata->>'first_name', metadata->>'First_Name', ''),
+  coalesce(metadata->>'last_name', metadata->>'Last_Name', ''),
+  coalesce(metadata->>'dob', metadata->>'Date_of_birth', metadata->>'DOB', '')
+from (
+  select id, metadata, chunk_patient_id(metadata) as pid
+  from rag_chunks
+) c
+where pid is not null
+order by pid, id desc
+on conflict (patient_id) do update set
+  first_name = excluded.first_name,
+  last_name  = excluded.last_name,
+  dob        = excluded.dob,
+  deleted    = false,
+  seq        = nextval(pg_get_serial_sequence('patients', 'seq'))
+where (patients.first_name, patients.last_name, patients.dob, patients.deleted)
+      is distinct from (excluded.first_name, excluded.last_name, excluded.dob, false);
+
+update patients p
+set deleted = true,
+    seq = nextval(pg_get_serial_sequence('patients', 'seq'))
+where not p.deleted
+  and not exists (select 1 from rag_chunks r where chunk_patient_id(r.metadata) = p.patient_id);
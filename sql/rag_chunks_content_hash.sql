@@ -0,0 +1,60 @@
+-- Stable content hash per chunk so ingestion is idempotent: ingest.py skips
+-- embedding for hashes already stored and upserts on the unique index.
+--
+-- content_hash = sha256(patient_id || 0x1f || doc_id || 0x1f || text with
+-- runs of ASCII whitespace collapsed to one space and trimmed), hex encoded -
+-- the same as ingest.chunk_hash(). Non-ASCII whitespace (e.g. NBSP) is kept
+-- as is on both sides.
+alter table rag_chunks add column if not exists content_hash text;
+
+create or replace function chunk_content_hash(metadata jsonb, content text)
+returns text
+language sql immutable
+as $$
+  select encode(sha256(convert_to(
+      coalesce(metadata->>'patient_id', metadata->>'Patient_Id', metadata->>'PatientID', '')
+      || chr(31) || coalesce(metadata->>'doc_id', '')
+      || chr(31) || btrim(regexp_replace(content, '[ \t\n\r\f\v]+', ' ', 'g'), ' '),
+    'UTF8')), 'hex');
+$$;
+
+-- Re-running recomputes hashes written with an older normalization; the
+-- unique index is rebuilt below once duplicates are gone
+drop index if exists rag_chunks_content_hash;
+
+update rag_chunks
+set content_hash = chunk_content_hash(metadata, content)
+where content_hash is distinct from chunk_content_hash(metadata, content);
+
+-- Drop rows duplicated by earlier re-ingests, keeping the oldest copy
+-- (their patient_facts rows go with them via on delete cascade)
+delete from rag_chunks a
+using rag_chunks b
+where a.content_hash = b.content_hash
+  and a.id > b.id;
+
+create unique index rag_chunks_content_hash on rag_chunks (content_hash);
+
+-- Which of the given hashes are already stored (POST body, so no URL limits)
+create or replace function existing_content_hashes(hashes text[])
+returns setof text
+language sql stable
+as $$
+  select content_hash from rag_chunks where content_hash = any(hashes);
+$$;
+
+-- Replaces the metadata of stored chunks when a re-ingested document's
+-- metadata changed (rows: [{"content_hash", "metadata"}]). Returns the
+-- updated chunks as {id, content, metadata} so their facts can be re-derived.
+drop function if exists refresh_chunk_metadata(jsonb);
+create function refresh_chunk_metadata(rows jsonb)
+returns setof jsonb
+language sql
+as $$
+  update rag_chunks r
+  set metadata = x.metadata
+  from jsonb_to_recordset(rows) as x(content_hash text, metadata jsonb)
+  where r.content_hash = x.content_hash
+    and r.metadata is distinct from x.metadata
+  returning jsonb_build_object('id', r.id, 'content', r.content, 'metadata', r.metadata);
+$$;
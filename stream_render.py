@@ -0,0 +1,98 @@
+import os
+import re
+import time
+from typing import Iterable
+from dotenv import load_dotenv
+
+load_dotenv()
+# Redraw the streaming answer at most every STREAM_RENDER_INTERVAL seconds
+# unless STREAM_RENDER_CHARS new characters arrived first
+STREAM_RENDER_INTERVAL = float(os.getenv("STREAM_RENDER_INTERVAL", "0.05"))
+STREAM_RENDER_CHARS = int(os.getenv("STREAM_RENDER_CHARS", "200"))
+
+# Markdown lines that make a block continue across a blank line: fence
+# delimiters, list items and indented (continuation / code) lines
+FENCE_LINE = re.compile(r"^ {0,3}(?:`{3,}|~{3,})")
+CONTINUED_LINE = re.compile(r"^(?:[ \t]|\s*(?:[-*+]|\d{1,9}[.)])(?:[ \t]|$))")
+
+
+class StreamRenderer:
+    """
+    Renders a streamed markdown answer into a Streamlit container.
+
+    Chunks are coalesced into frames (time or size based), and finished
+    paragraphs are frozen into their own element, so each frame only re-sends
+    the paragraph still being written instead of the whole answer. Code
+    fences, lists and indented blocks are never split across elements.
+    """
+
+    def __init__(self, container, interval: float = STREAM_RENDER_INTERVAL,
+                 min_chars: int = STREAM_RENDER_CHARS):
+        self.container = container
+        self.interval = interval
+        self.min_chars = min_chars
+        self.text = ""
+        self._frozen = 0     # text[:_frozen] is rendered in frozen elements
+        self._rendered = 0   # len(text) at the last frame
+        self._last = 0.0
+        self._tail = container.empty()
+
+    def _paragraph_end(self) -> int:
+        """
+        End of the last blank line after _frozen where the markdown can be split
+        without changing how it renders: outside code fences and not inside
+        or right before a list or indented block. The block after the break
+        must have a complete first line before the break counts.
+        """
+        cut = self._frozen
+        pos = self._frozen
+        in_fence = False
+        while True:
+            brk = self.text.find("\n\n", pos)
+            if brk < 0:
+                return cut
+            lines = self.text[pos:brk].strip("\n").split("\n")
+            for line in lines:
+                if FENCE_LINE.match(line):
+                    in_fence = not in_fence
+            rest = self.text[brk + 2:].lstrip("\n")
+            if "\n" not in rest:
+                return cut
+            if not (in_fence
+                    or any(CONTINUED_LINE.match(line) for line in lines)
+                    or CONTINUED_LINE.match(rest)):
+                cut = brk + 2
+            pos = brk + 2
+
+    def _render(self) -> None:
+        cut = self._paragraph_end()
+        if cut > self._frozen:
+            # Final draw of the finished paragraphs; later frames leave them alone
+            self._tail.markdown(self.text[self._frozen:cut])
+            self._tail = self.container.empty()
+            self._frozen = cut
+        if len(self.text) > self._frozen:
+            self._tail.markdown(self.text[self._frozen:])
+        self._rendered = len(self.text)
+        self._last = time.monotonic()
+
+    def write(self, chunk: str) -> None:
+        if not chunk:
+            return
+        self.text += chunk
+        if (len(self.text) - self._rendered >= self.min_chars
+                or time.monotonic() - self._last >= self.interval):
+            self._render()
+
+    def close(self) -> str:
+        """Draws whatever is still buffered and returns the full answer."""
+        if len(self.text) > self._rendered:
+            self._render()
+        return self.text
+
+
+def render_stream(container, chunks: Iterable[str]) -> str:
+    renderer = StreamRenderer(container)
+    for chunk in chunks:
+        renderer.write(chunk)
+    return renderer.close()
@@ -1,12 +1,121 @@
 import os
-from supabase import create_client, Client
+import atexit
+import asyncio
+import threading
+import weakref
+from typing import Any, Dict, Optional
+import httpx
+from supabase import (create_client, Client, ClientOptions, acreate_client,
+                      AsyncClient, AsyncClientOptions)
 from dotenv import load_dotenv
 
 load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SERVICE_SUPABASEANON_KEY")
+# Service role key, only used by ingestion jobs that write
+SUPABASE_SERVICE_KEY = os.getenv("SERVICE_SUPABASESERVICE_KEY")
+
+# Shared HTTP connection pool (one per process, reused by every module)
+POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "20"))
+POOL_IDLE_TIMEOUT = float(os.getenv("SUPABASE_POOL_IDLE_TIMEOUT", "60"))
+HTTP_TIMEOUT = float(os.getenv("SUPABASE_HTTP_TIMEOUT", "120"))
+HTTP2 = os.getenv("SUPABASE_HTTP2", "1") not in ("0", "false", "False")
+
+try:
+    import h2  # noqa: F401 - httpx only speaks HTTP/2 when h2 is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_client: Optional[Client] = None
+# Async clients are bound to the event loop that created them
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncClient]" = weakref.WeakKeyDictionary()
+_async_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+
+def _http_client_options() -> Dict[str, Any]:
+    return dict(
+        http2=HTTP2 and HTTP2_AVAILABLE,
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=POOL_SIZE,
+            max_keepalive_connections=POOL_SIZE,
+            keepalive_expiry=POOL_IDLE_TIMEOUT,
+        ),
+    )
+
+
+def get_http_client() -> httpx.Client:
+    """Process-wide keep-alive httpx client used by the Supabase client."""
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = httpx.Client(**_http_client_options())
+    return _http_client
+
 
 def get_supabase() -> Client:
+    """
+    Returns the shared Supabase client. The client (and its connection pool)
+    is created once per process and reused across calls, threads and
+    Streamlit sessions.
+    """
+    global _client
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise RuntimeError("Missing SUPABASE_URL or key.")
+    if _client is None:
+        http_client = get_http_client()
+        with _lock:
+            if _client is None:
+                _client = create_client(
+                    SUPABASE_URL, SUPABASE_KEY,
+                    options=ClientOptions(httpx_client=http_client))
+    return _client
+
+
+async def get_async_supabase() -> AsyncClient:
+    """
+    Async Supabase client for the running event loop, with its own pooled
+    httpx.AsyncClient. Created once per loop and reused afterwards.
+    """
     if not SUPABASE_URL or not SUPABASE_KEY:
         raise RuntimeError("Missing SUPABASE_URL or key.")
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        with _lock:
+            loop_lock = _async_locks.setdefault(loop, asyncio.Lock())
+        # Coroutines racing on the first call wait for a single client
+        async with loop_lock:
+            client = _async_clients.get(loop)
+            if client is None:
+                client = _async_clients[loop] = await acreate_client(
+                    SUPABASE_URL, SUPABASE_KEY,
+                    options=AsyncClientOptions(httpx_client=httpx.AsyncClient(**_http_client_options())))
+    return client
+
+
+async def acreate_service_supabase() -> AsyncClient:
+    """New async client with the service role key and its own pool, for bulk writes."""
+    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+        raise RuntimeError("Missing SUPABASE_URL or SERVICE_SUPABASESERVICE_KEY.")
+    return await acreate_client(
+        SUPABASE_URL, SUPABASE_SERVICE_KEY,
+        options=AsyncClientOptions(httpx_client=httpx.AsyncClient(**_http_client_options())))
+
+
+def close_supabase() -> None:
+    """Closes the shared connection pool; the next call reopens it."""
+    global _http_client, _client
+    with _lock:
+        if _http_client is not None:
+            _http_client.close()
+        _http_client = None
+        _client = None
+
+
+atexit.register(close_supabase)
@@ -0,0 +1,64 @@
+import os
+import unittest
+from unittest import mock
+
+for _key in ("OPENAI_API_KEY", "SUPABASE_URL", "SERVICE_SUPABASEANON_KEY", "SERVICE_SUPABASESERVICE_KEY"):
+    os.environ.setdefault(_key, "test")
+
+import engine  # noqa: E402
+
+PATIENTS = [
+    {"patient_id": "IVF001", "first_name": "Priya", "last_name": "Shah", "dob": "1990-01-01"},
+    {"patient_id": "IVF002", "first_name": "Meera", "last_name": "Rao", "dob": "1988-05-02"},
+]
+AMH_FACTS = {
+    "IVF001": [{"patient_id": "IVF001", "attribute": "amh", "value_num": 1.2, "value_text": "AMH 1.2",
+                "unit": "ng/mL", "observed_on": "2024-01-05", "chunk_id": 11}],
+    "IVF002": [{"patient_id": "IVF002", "attribute": "amh", "value_num": 0.8, "value_text": "AMH 0.8",
+                "unit": "ng/mL", "observed_on": "2024-02-01", "chunk_id": 12}],
+}
+
+
+async def _fake_retrieval(prompt, patients):
+    context = {f"{p['first_name']} {p['last_name']}": [f"chunk for {p['patient_id']}"] for p in patients}
+    return context, [{"patient_id": p["patient_id"]} for p in patients]
+
+
+class StructuredContextTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(engine, "_amulti_patient_context", side_effect=_fake_retrieval),
+            mock.patch.object(engine, "afetch_facts", new=mock.AsyncMock(return_value=AMH_FACTS)),
+        ]
+        self.retrieval, self.fetch = (p.start() for p in patches)
+        for p in patches:
+            self.addCleanup(p.stop)
+
+    async def test_no_structured_attribute_uses_retrieval(self):
+        context, _ = await engine._astructured_context("Compare Priya and Meera diagnoses", PATIENTS)
+        self.fetch.assert_not_called()
+        self.assertEqual(context, {"Priya Shah": ["chunk for IVF001"], "Meera Rao": ["chunk for IVF002"]})
+
+    async def test_disabled_flag_uses_retrieval(self):
+        with mock.patch.object(engine, "STRUCTURED_FACTS", False):
+            context, _ = await engine._astructured_context("Compare AMH for Priya and Meera", PATIENTS)
+        self.fetch.assert_not_called()
+        self.assertEqual(context, {"Priya Shah": ["chunk for IVF001"], "Meera Rao": ["chunk for IVF002"]})
+
+    async def test_structured_question_skips_retrieval(self):
+        context, sources = await engine._astructured_context("Compare AMH for Priya and Meera", PATIENTS)
+        self.retrieval.assert_not_called()
+        self.assertEqual([len(blocks) for blocks in context.values()], [1, 1])
+        self.assertIn("amh: 1.2 ng/mL", context["Priya Shah"][0])
+        self.assertEqual({s["source"] for s in sources}, {"patient_facts"})
+
+    async def test_mixed_question_keeps_chunks(self):
+        context, _ = await engine._astructured_context(
+            "Compare Priya and Meera AMH and treatment plans", PATIENTS)
+        self.assertIn("amh: 0.8 ng/mL", context["Meera Rao"][0])
+        self.assertEqual(context["Meera Rao"][1], "chunk for IVF002")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import unittest
+
+for _key in ("SUPABASE_URL", "SERVICE_SUPABASEANON_KEY", "SERVICE_SUPABASESERVICE_KEY"):
+    os.environ.setdefault(_key, "test")
+
+from patient_facts import extract_facts, format_facts, requested_attributes, structured_only  # noqa: E402
+
+
+def _values(text):
+    return [(f["attribute"], f["value_num"], f["unit"]) for f in extract_facts(text)]
+
+
+class ExtractMeasurementsTest(unittest.TestCase):
+    CASES = [
+        # text, expected (attribute, canonical value, unit) rows
+        ("Height 162 cm", [("height", 162.0, "cm")]),
+        ("Height: 1.62 m", [("height", 162.0, "cm")]),
+        ("Height 64 inches", [("height", 162.56, "cm")]),
+        ("Height 162 in March.", [("height", 162.0, "cm")]),
+        ("Height: 5 ft 4 in", [("height", 162.56, "cm")]),
+        ("Height 5'4\"", [("height", 162.56, "cm")]),
+        ("Height 5 feet", [("height", 152.4, "cm")]),
+        ("Height 12 noted", []),
+        ("Weight 150 lbs", [("weight", 68.04, "kg")]),
+        ("Weight: 58kg", [("weight", 58.0, "kg")]),
+        ("Weight 5000", []),
+        ("Temperature 37 c/o headache", [("temperature", 37.0, "°C")]),
+        ("Temp 98.6 F", [("temperature", 37.0, "°C")]),
+        ("Temperature 101.2", [("temperature", 38.444, "°C")]),
+        ("Temperature 37.2 °C", [("temperature", 37.2, "°C")]),
+        ("AMH 20 pmol/L", [("amh", 2.801, "ng/mL")]),
+        ("AMH: 1.2 ng/mL", [("amh", 1.2, "ng/mL")]),
+        ("FSH 7.5 IU/L", [("fsh", 7.5, "mIU/mL")]),
+        ("E2 250 pmol/L", [("e2", 68.101, "pg/mL")]),
+        ("BMI 22.4", [("bmi", 22.4, "kg/m2")]),
+        ("BP 120/80", [("bp_systolic", 120.0, "mmHg"), ("bp_diastolic", 80.0, "mmHg")]),
+        ("BP 12/8", []),
+    ]
+
+    def test_cases(self):
+        for text, expected in self.CASES:
+            with self.subTest(text=text):
+                self.assertEqual(_values(text), expected)
+
+    def test_observed_on_prefers_metadata_date(self):
+        facts = extract_facts("Visit 2023-01-02. AMH 1.1", {"visit_date": "2024-03-04"})
+        self.assertEqual(facts[0]["observed_on"], "2024-03-04")
+        facts = extract_facts("Visit 2023-01-02. AMH 1.1")
+        self.assertEqual(facts[0]["observed_on"], "2023-01-02")
+
+
+class ExtractMedicationsTest(unittest.TestCase):
+    CASES = [
+        ("Letrozole 2.5 mg", [("Letrozole", 2.5, "mg")]),
+        ("Folic acid 5 mg daily", [("Folic acid", 5.0, "mg")]),
+        ("Gonal-f 150 IU", [("Gonal-f", 150.0, "IU")]),
+        ("Take letrozole 2.5 mg", [("Letrozole", 2.5, "mg")]),
+        ("Started Menopur 75 IU", [("Menopur", 75.0, "IU")]),
+        ("Dose 5 mg daily", []),
+        ("Daily dose 5 mg", []),
+        ("Total 300 IU", []),
+        ("Weight 58 kg", []),
+    ]
+
+    def test_cases(self):
+        for text, expected in self.CASES:
+            with self.subTest(text=text):
+                meds = [(f["value_text"], f["value_num"], f["unit"])
+                        for f in extract_facts(text) if f["attribute"] == "medication"]
+                self.assertEqual(meds, expected)
+
+
+class QueryAttributesTest(unittest.TestCase):
+    REQUESTED = [
+        ("Who is taller, Priya or Meera?", {"height"}),
+        ("Compare their weights and BMI", {"weight", "bmi"}),
+        ("What is her blood pressure?", {"blood pressure"}),
+        ("Latest AMH and FSH for both", {"AMH", "FSH"}),
+        ("Which medications is she prescribed?", {"medications"}),
+        ("Compare Priya and Meera diagnoses", set()),
+    ]
+    STRUCTURED_ONLY = [
+        ("Who is taller, Priya or Meera?", True),
+        ("Compare AMH levels for Priya and Meera", True),
+        ("What is the BMI of Priya Shah and Meera Rao?", True),
+        ("Compare Priya and Meera diagnoses", False),
+        ("Compare their AMH and treatment plans", False),
+    ]
+
+    def test_requested_attributes(self):
+        for prompt, expected in self.REQUESTED:
+            with self.subTest(prompt=prompt):
+                self.assertEqual(set(requested_attributes(prompt)), expected)
+
+    def test_structured_only(self):
+        for prompt, expected in self.STRUCTURED_ONLY:
+            with self.subTest(prompt=prompt):
+                self.assertIs(structured_only(prompt, ["Priya Shah", "Meera Rao"]), expected)
+
+    def test_format_facts(self):
+        rows = [
+            {"attribute": "amh", "value_num": 1.2, "value_text": "AMH 1.2", "unit": "ng/mL",
+             "observed_on": "2024-01-05"},
+            {"attribute": "medication", "value_num": 2.5, "value_text": "Letrozole", "unit": "mg",
+             "observed_on": None},
+        ]
+        self.assertEqual(format_facts("Priya Shah", rows),
+                         "[Priya Shah]: Structured record (most recent first)\n"
+                         "- amh: 1.2 ng/mL (2024-01-05)\n"
+                         "- medication: Letrozole 2.5 mg")
+
+
+if __name__ == "__main__":
+    unittest.main()